@@ -0,0 +1,147 @@
+import os
+import sys
+
+from .message_stream import BASE64_LINE_BYTES
+from .message_stream import READ_CHUNK_SIZE
+
+ARCHIVE_NAME = 'attachments'
+ARCHIVE_FORMATS = ['zip', 'tar.gz', 'tar.bz2', 'tar.xz']
+DEFAULT_COMPRESSION_LEVEL = 9
+# Allowance for the headers of each MIME part, and for the message headers,
+# text and signature around the attachments
+PART_OVERHEAD = 512
+MESSAGE_OVERHEAD = 4096
+# Allowance for the headers of each file in an archive, and for the end of
+# the archive and its compression
+MEMBER_OVERHEAD = 512
+ARCHIVE_OVERHEAD = 1024
+
+
+def encoded_size(size):
+    # Size of base64 encoded content, with 76 characters and CRLF per line
+    return (size + BASE64_LINE_BYTES - 1) // BASE64_LINE_BYTES * 78
+
+
+def archive_names(files):
+    # Names of files within an archive, made unique when files in different
+    # directories have the same name
+    names = []
+    for filename in files:
+        name = os.path.basename(filename)
+        base, ext = os.path.splitext(name)
+        i = 1
+        while name in names:
+            i += 1
+            name = '{}-{}{}'.format(base, i, ext)
+        names.append(name)
+    return names
+
+
+def compression_level(archive_format, level):
+    # bzip2 has no level without compression, so its lowest level is used
+    if archive_format == 'tar.bz2':
+        return max(level, 1)
+    return level
+
+
+def write_archive(archive_file, files, archive_format, level):
+    names = archive_names(files)
+    level = compression_level(archive_format, level)
+    if archive_format == 'zip':
+        import zipfile
+        kwargs = {}
+        if sys.version_info >= (3, 7):
+            kwargs['compresslevel'] = level
+        with zipfile.ZipFile(archive_file, 'w', zipfile.ZIP_DEFLATED,
+                             **kwargs) as archive:
+            for filename, name in zip(files, names):
+                archive.write(filename, name)
+        return
+    import tarfile
+    compression = archive_format.split('.', 1)[1]
+    kwargs = {'preset': level} if compression == 'xz' else {
+        'compresslevel': level}
+    with tarfile.open(archive_file, 'w:{}'.format(compression),
+                      **kwargs) as archive:
+        for filename, name in zip(files, names):
+            archive.add(filename, name)
+
+
+def compressed_size(filename, archive_format, level):
+    # Size of a file compressed on its own, as it is in a zip archive. Files
+    # in a tar archive are compressed together, which is usually smaller.
+    level = compression_level(archive_format, level)
+    if archive_format == 'tar.bz2':
+        import bz2
+        compressor = bz2.BZ2Compressor(level)
+    elif archive_format == 'tar.xz':
+        import lzma
+        compressor = lzma.LZMACompressor(preset=level)
+    else:
+        import zlib
+        if archive_format == 'zip' and sys.version_info < (3, 7):
+            level = zlib.Z_DEFAULT_COMPRESSION
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    size = 0
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+            size += len(compressor.compress(chunk))
+    return size + len(compressor.flush())
+
+
+class AttachmentPacker(object):
+    def __init__(self, max_size=None, archive_format=None,
+                 level=DEFAULT_COMPRESSION_LEVEL, cache=None):
+        if archive_format and archive_format not in ARCHIVE_FORMATS:
+            raise Exception('Unknown archive format {}'
+                            .format(archive_format))
+        if archive_format and not cache:
+            raise Exception('Archiving attachments requires a message cache')
+        self.max_size = max_size
+        self.archive_format = archive_format
+        self.level = level
+        self.cache = cache
+
+    def pack(self, files, reserved=0):
+        # Returns the files to attach, and (filename, size) for each file
+        # omitted to fit the size budget. Files listed first have the highest
+        # priority, so files are omitted starting from the end of the list.
+        available = None
+        if self.max_size:
+            available = self.max_size - reserved - MESSAGE_OVERHEAD
+        included = []
+        omitted = []
+        for filename in files:
+            try:
+                included.append((filename, os.path.getsize(filename)))
+            except OSError:
+                omitted.append((filename, None))
+        if self.archive_format:
+            if available is not None:
+                # Files are chosen by their compressed sizes, so only the
+                # archive which is attached is built
+                total = ARCHIVE_OVERHEAD
+                for i, (filename, size) in enumerate(included):
+                    total += MEMBER_OVERHEAD + self.cache.compressed_size(
+                        filename, self.archive_format, self.level)
+                    if encoded_size(total) + PART_OVERHEAD > available:
+                        omitted = included[i:] + omitted
+                        included = included[:i]
+                        break
+            while included:
+                archive = self.cache.archive(
+                    [filename for filename, size in included],
+                    self.archive_format, self.level)
+                if available is None or self._cost(archive) <= available:
+                    return [archive], omitted
+                self.cache.remove_archive(archive)
+                omitted.insert(0, included.pop())
+            return [], omitted
+        while available is not None and included and sum(
+                encoded_size(size) + PART_OVERHEAD
+                for filename, size in included) > available:
+            omitted.insert(0, included.pop())
+        return [filename for filename, size in included], omitted
+
+    def _cost(self, filename):
+        return encoded_size(os.path.getsize(filename)) + PART_OVERHEAD
@@ -0,0 +1,27 @@
+import json
+import threading
+
+
+class SharedClients(object):
+    # Clients shared by the tenants of a multi-tenant run. Clients are keyed
+    # by their kind and all of their settings, including credentials, so
+    # only tenants with identical settings share a client (and with it its
+    # connections and rate limit).
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, kind, settings, create):
+        key = (kind, json.dumps(settings, sort_keys=True))
+        with self._lock:
+            if key not in self._clients:
+                self._clients[key] = create()
+            return self._clients[key]
+
+    def close(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients = {}
+        for client in clients:
+            if hasattr(client, 'close'):
+                client.close()
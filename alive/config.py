@@ -1,17 +1,244 @@
+import hashlib
+import marshal
 import os
 
-import yaml
-
 DEFAULT_CONFIG_DIR = os.path.join(os.path.expanduser('~'), '.alive')
 CONFIG_DIR_MODE = 0o0700
+CONFIG_FILE_NAME = 'config.yaml'
+CONFIG_CACHE_DIR_NAME = 'cache'
+CONFIG_CACHE_FILE_NAME = 'config.bin'
+
+
+class ConfigError(Exception):
+    pass
+
+
+class Option(object):
+    def __init__(self, types, required=False, items=str, check=None):
+        self.types = types if isinstance(types, tuple) else (types,)
+        self.required = required
+        self.items = items
+        self.check = check
+
+    def validate(self, path, value):
+        if not self._is_instance(value):
+            if list in self.types and isinstance(value, list):
+                raise ConfigError('{} must be {}'.format(
+                    path, self._type_names(list)))
+            raise ConfigError('{} must be {}, not {}'.format(
+                path, self._type_names(*self.types), repr(value)))
+        if self.check:
+            self.check(path, value)
+
+    def _is_instance(self, value):
+        if isinstance(value, bool) and bool not in self.types:
+            return False
+        if isinstance(value, list) and list in self.types:
+            return all(isinstance(item, self.items) for item in value)
+        return isinstance(value, self.types)
+
+    def _type_names(self, *types):
+        return ' or '.join({
+            bool: 'a boolean',
+            dict: 'a mapping',
+            float: 'a number',
+            int: 'an integer',
+            list: 'a list of {}'.format(
+                'mappings' if self.items is dict else 'strings'),
+            str: 'a string',
+        }[t] for t in types)
+
+
+def _check_rules(path, rules):
+    # The rules are compiled to report invalid rules and patterns when the
+    # configuration is loaded
+    from .rules import RuleSet
+    RuleSet(rules, path)
+
+
+def _check_groups(path, groups):
+    for name, members in groups.items():
+        Option(STRINGS).validate('{}.{}'.format(path, name), members)
+
+
+def _check_archive(path, archive_format):
+    from .archive import ARCHIVE_FORMATS
+    if archive_format not in ARCHIVE_FORMATS:
+        raise ConfigError('{} must be one of {}'
+                          .format(path, ', '.join(ARCHIVE_FORMATS)))
+
+
+def _check_compression_level(path, level):
+    if not 0 <= level <= 9:
+        raise ConfigError('{} must be between 0 and 9'.format(path))
+
+
+def _check_page_size(path, page_size):
+    # The Twitter API returns at most 200 tweets per page
+    if not 1 <= page_size <= 200:
+        raise ConfigError('{} must be between 1 and 200'.format(path))
+
+
+def _check_positive(path, value):
+    if value < 1:
+        raise ConfigError('{} must be at least 1'.format(path))
+
+
+def _check_profiles(path, profiles):
+    for name, profile in profiles.items():
+        profile_path = '{}.{}'.format(path, name)
+        if not isinstance(profile, dict):
+            raise ConfigError('{} must be a mapping'.format(profile_path))
+        for option_name, value in profile.items():
+            if option_name not in PROFILE_OPTIONS:
+                raise ConfigError('Unknown option {}.{}'
+                                  .format(profile_path, option_name))
+            if value is not None:
+                SCHEMA['email'][option_name].validate(
+                    '{}.{}'.format(profile_path, option_name), value)
+
+
+NUMBER = (int, float)
+STRINGS = (str, list)
+
+# Sections and their options. Sections listed in REQUIRED_SECTIONS must be
+# present, and all other sections are optional.
+SCHEMA = {
+    'email': {
+        'from': Option(str, required=True),
+        'to': Option(STRINGS, required=True),
+        'cc': Option(STRINGS),
+        'bcc': Option(STRINGS),
+        'subject': Option(str),
+        'message': Option(str),
+        'attachments': Option(list),
+        'transport': Option(dict),
+        'profiles': Option(dict, check=_check_profiles),
+        'groups': Option(dict, check=_check_groups),
+        'max_size': Option(int),
+        'archive': Option(str, check=_check_archive),
+        'compression_level': Option(int, check=_check_compression_level),
+    },
+    'triggers': {
+        'rules': Option(list, items=dict, check=_check_rules),
+        'coalesce_window': Option(NUMBER),
+    },
+    'lock': {
+        'timeout': Option(NUMBER),
+    },
+    'twitter': {
+        'username': Option(STRINGS, required=True),
+        'keyword': Option(STRINGS),
+        'consumer_key': Option(str, required=True),
+        'consumer_secret': Option(str, required=True),
+        'access_token_key': Option(str, required=True),
+        'access_token_secret': Option(str, required=True),
+        'api_url': Option(str),
+        'concurrency': Option(int),
+        'timeout': Option(NUMBER),
+        'rate_limit_reserve': Option(int),
+        'rate_limit_max_wait': Option(NUMBER),
+        'page_size': Option(int, check=_check_page_size),
+        'max_backfill': Option(int, check=_check_positive),
+    },
+    'webhook': {
+        'secret': Option(str, required=True),
+        'keyword': Option(STRINGS),
+        'host': Option(str),
+        'port': Option(int),
+        'socket': Option(str),
+        'path': Option(str),
+        'signature_header': Option(str),
+        'timestamp_header': Option(str),
+        'max_age': Option(int, check=_check_positive),
+        'text_field': Option(str),
+        'id_field': Option(str),
+        'max_body_size': Option(int),
+        'max_connections': Option(int, check=_check_positive),
+        'queue_size': Option(int),
+    },
+    'periodic_test': {
+        'enabled': Option(bool),
+        'interval': Option(NUMBER),
+    },
+    'sources': {
+        'timeout': Option(NUMBER),
+        'timeouts': Option(dict),
+    },
+    'daemon': {
+        'interval': Option(NUMBER),
+        'jitter': Option(NUMBER),
+        'max_backoff': Option(NUMBER),
+        'intervals': Option(dict),
+    },
+    'outbox': {
+        'retry_interval': Option(NUMBER),
+        'max_retry_interval': Option(NUMBER),
+        'max_envelope_recipients': Option(int),
+        'concurrency': Option(int),
+    },
+    'metrics': {
+        'enabled': Option(bool),
+        'log_file': Option(str),
+        'max_log_size': Option(int),
+        'textfile': Option(str),
+    },
+}
+REQUIRED_SECTIONS = ['email']
+# Email options which a message profile may override
+PROFILE_OPTIONS = ['to', 'cc', 'bcc', 'subject', 'message', 'attachments']
+
+
+def validate(config):
+    if not isinstance(config, dict):
+        raise ConfigError('Configuration must be a mapping of sections')
+    for section in REQUIRED_SECTIONS:
+        if not config.get(section):
+            raise ConfigError('Required section {} is not configured'
+                              .format(section))
+    for section, values in config.items():
+        if section not in SCHEMA:
+            raise ConfigError('Unknown section {}'.format(section))
+        if values is None:
+            continue
+        if not isinstance(values, dict):
+            raise ConfigError('Section {} must be a mapping'.format(section))
+        options = SCHEMA[section]
+        for name, option in sorted(options.items()):
+            if option.required and values.get(name) in (None, '', []):
+                raise ConfigError('{}.{} is required'.format(section, name))
+        for name, value in values.items():
+            if name not in options:
+                raise ConfigError('Unknown option {}.{}'
+                                  .format(section, name))
+            if value is not None:
+                options[name].validate('{}.{}'.format(section, name), value)
+    profiles = (config.get('email') or {}).get('profiles') or {}
+    rules = (config.get('triggers') or {}).get('rules') or []
+    for i, rule in enumerate(rules):
+        if rule.get('profile') and rule['profile'] not in profiles:
+            raise ConfigError('triggers.rules[{}]: Unknown profile {}'
+                              .format(i, rule['profile']))
+
+
+def _schema_digest():
+    return hashlib.sha256(repr(sorted(
+        (section, sorted((name, option.types, option.required, option.items)
+                         for name, option in options.items()))
+        for section, options in SCHEMA.items()
+    )).encode('UTF-8')).hexdigest()
 
 
 class Config(object):
-    def __init__(self, config_dir):
+    def __init__(self, config_dir, use_cache=True):
         self._config_dir = config_dir
+        self._file_name = os.path.join(self._config_dir, CONFIG_FILE_NAME)
+        self._cache_file = os.path.join(self._config_dir,
+                                        CONFIG_CACHE_DIR_NAME,
+                                        CONFIG_CACHE_FILE_NAME)
         self._ensure_config_dir()
         self._config = None
-        self._load()
+        self._load(use_cache)
 
     def _ensure_config_dir(self):
         if not os.path.isdir(self._config_dir):
@@ -26,20 +253,66 @@ class Config(object):
             print('Correcting mode on {}'.format(self._config_dir))
             os.chmod(self._config_dir, CONFIG_DIR_MODE)
 
-    def _load(self):
-        file_name = os.path.join(self._config_dir, 'config.yaml')
-        with open(file_name, 'r') as config_f:
-            loaded = yaml.load(config_f)
+    def _load(self, use_cache=True):
+        stat = os.stat(self._file_name)
+        schema = _schema_digest()
+        cached = self._load_cache() if use_cache else None
+        if not isinstance(cached, dict) or cached.get('schema') != schema:
+            cached = None
+        if (cached and cached['mtime'] == stat.st_mtime_ns and
+                cached['size'] == stat.st_size):
+            self._config = cached['config']
+            return
+        with open(self._file_name, 'rb') as config_f:
+            content = config_f.read()
+        digest = hashlib.sha256(content).hexdigest()
+        if cached and cached['sha256'] == digest:
+            self._config = cached['config']
+        else:
+            # yaml is only imported when the configuration has changed
+            import yaml
+            try:
+                loaded = yaml.safe_load(content)
+            except yaml.YAMLError as e:
+                raise ConfigError('Error parsing {}: {}'
+                                  .format(self._file_name, e))
+            try:
+                validate(loaded)
+            except ConfigError as e:
+                raise ConfigError('{}: {}'.format(self._file_name, e))
             self._config = loaded
+        self._save_cache({
+            'schema': schema,
+            'mtime': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'sha256': digest,
+            'config': self._config,
+        })
+
+    def _load_cache(self):
+        try:
+            with open(self._cache_file, 'rb') as f:
+                return marshal.load(f)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+
+    def _save_cache(self, cached):
+        try:
+            cache_dir = os.path.dirname(self._cache_file)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            temp_file = '{}.{}.tmp'.format(self._cache_file, os.getpid())
+            with open(temp_file, 'wb') as f:
+                marshal.dump(cached, f)
+            os.replace(temp_file, self._cache_file)
+        except (IOError, OSError, ValueError) as e:
+            print('WARNING: Unable to write configuration cache: {}'
+                  .format(e))
 
-    def __getattr__(self, name, default_value=None):
-        if not self._config:
-            return default_value
-        if name in self._config:
-            return self._config.get(name, default_value)
-        if default_value:
-            return default_value
-        raise ValueError('{} not in {}'.format(name, self))
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in SCHEMA:
+            raise AttributeError(name)
+        return self._config.get(name)
 
     def __contains__(self, name):
         return name in self._config
@@ -0,0 +1,188 @@
+from __future__ import print_function
+
+import heapq
+import random
+import signal
+import sys
+import threading
+import time
+import traceback
+
+from .lock import LockTimeout
+
+DEFAULT_INTERVAL = 300
+DEFAULT_JITTER = 30
+DEFAULT_MAX_BACKOFF = 3600
+
+
+class Daemon(object):
+    def __init__(self, alive, source_classes):
+        self._alive = alive
+        self._source_classes = {
+            source_class.name: source_class
+            for source_class in source_classes
+        }
+        self._sources = {}
+        self._failures = {}
+        self._schedule = []
+        self._settings = {}
+        self._retry_at = None
+        # Names of push sources with triggers waiting to be checked
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = False
+        self._reload = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_reload)
+        self._load()
+        while not self._stop:
+            if self._reload:
+                self._reload = False
+                print('Reloading configuration')
+                self._load()
+                continue
+            if self._pending:
+                self._run_pending()
+                continue
+            now = time.time()
+            if self._retry_at is not None and self._retry_at <= now:
+                self._deliver_outbox()
+                continue
+            if self._schedule and self._schedule[0][0] <= now:
+                next_run, name = heapq.heappop(self._schedule)
+                self._run_source(name)
+                continue
+            wakeups = [self._retry_at] if self._retry_at is not None else []
+            if self._schedule:
+                wakeups.append(self._schedule[0][0])
+            self._wakeup.wait(min(wakeups) - now if wakeups else None)
+            self._wakeup.clear()
+        print('Shutting down')
+        self._stop_sources()
+
+    def _handle_stop(self, signum, frame):
+        self._stop = True
+        self._wakeup.set()
+
+    def _handle_reload(self, signum, frame):
+        self._reload = True
+        self._wakeup.set()
+
+    def _load(self):
+        self._stop_sources()
+        self._alive.reload()
+        self._sources = {}
+        self._failures = {}
+        self._schedule = []
+        try:
+            config = self._alive.config
+            self._settings = (config.daemon if 'daemon' in config
+                              else None) or {}
+            self._alive.prepare()
+        except Exception:
+            traceback.print_exc()
+        for name, source_class in self._source_classes.items():
+            self._schedule_source(name, self._jitter())
+            if source_class.push:
+                # Push sources start receiving triggers straight away,
+                # rather than when they are first checked
+                try:
+                    self._source(name)
+                except Exception:
+                    print('Error starting source {}:'.format(name),
+                          file=sys.stderr)
+                    traceback.print_exc()
+        self._retry_at = time.time()
+
+    def _source(self, name):
+        source = self._sources.get(name)
+        if not source:
+            source = self._source_classes[name](self._alive.config,
+                                                self._alive.state,
+                                                self._alive.metrics)
+            source.start(lambda: self._notify(name))
+            self._sources[name] = source
+        return source
+
+    def _stop_sources(self):
+        for name, source in self._sources.items():
+            try:
+                source.stop()
+            except Exception:
+                traceback.print_exc()
+
+    def _notify(self, name):
+        # Called by push sources from other threads
+        with self._pending_lock:
+            self._pending.add(name)
+        self._wakeup.set()
+
+    def _run_pending(self):
+        with self._pending_lock:
+            names = self._pending
+            self._pending = set()
+        for name in names:
+            # The source's scheduled checks continue as before
+            self._run_source(name, reschedule=False)
+
+    def _deliver_outbox(self):
+        try:
+            with self._alive.lock():
+                self._alive.deliver_outbox()
+        except Exception:
+            # Errors outside of delivering individual messages, such as an
+            # invalid transport configuration
+            traceback.print_exc()
+            self._retry_at = time.time() + self._settings.get(
+                'interval', DEFAULT_INTERVAL)
+            return
+        self._update_retry()
+
+    def _update_retry(self):
+        try:
+            self._retry_at = self._alive.outbox.next_attempt()
+        except Exception:
+            traceback.print_exc()
+            self._retry_at = None
+
+    def _interval(self, name):
+        intervals = self._settings.get('intervals') or {}
+        return intervals.get(name,
+                             self._settings.get('interval', DEFAULT_INTERVAL))
+
+    def _jitter(self):
+        return random.uniform(0, self._settings.get('jitter', DEFAULT_JITTER))
+
+    def _schedule_source(self, name, delay):
+        heapq.heappush(self._schedule, (time.time() + delay, name))
+
+    def _run_source(self, name, reschedule=True):
+        try:
+            source = self._source(name)
+            with self._alive.lock():
+                self._alive.check_source(source)
+        except LockTimeout as e:
+            # Another process is checking the same configuration directory,
+            # which is not counted as a failure of the source
+            print('Not checking source {}: {}'.format(name, e),
+                  file=sys.stderr)
+        except Exception:
+            self._failures[name] = self._failures.get(name, 0) + 1
+            print('Error checking source {} (failure {}):'
+                  .format(name, self._failures[name]), file=sys.stderr)
+            traceback.print_exc()
+        else:
+            self._failures[name] = 0
+        self._update_retry()
+        if not reschedule:
+            return
+        delay = self._interval(name)
+        if self._failures.get(name):
+            delay = min(delay * 2 ** self._failures[name],
+                        self._settings.get('max_backoff',
+                                           DEFAULT_MAX_BACKOFF))
+        self._schedule_source(name, delay + self._jitter())
@@ -5,13 +5,25 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 from email.encoders import encode_base64
+from email.utils import getaddresses
+from email.utils import parseaddr
+import io
 import mimetypes
 import os
-import subprocess
+import shutil
 import sys
+import tempfile
 import traceback
 
-import gnupg
+from .message_stream import CRLFWriter
+from .message_stream import READ_CHUNK_SIZE
+from .message_stream import StreamedPart
+from .message_stream import write_message
+from .metrics import Metrics
+from .recipients import dedupe
+from .recipients import expand
+from .signing import Signer
+from .transport import SendmailTransport
 
 # https://tools.ietf.org/html/rfc4880#section-9.4
 OPENPGP_HASH_ALGORITHMS = {
@@ -23,6 +35,35 @@ OPENPGP_HASH_ALGORITHMS = {
     10: 'SHA512',
     11: 'SHA224',
 }
+# MIME types of compressed files, which mimetypes reports as the type of the
+# uncompressed file along with an encoding
+ENCODING_MIMETYPES = {
+    'gzip': 'application/gzip',
+    'bzip2': 'application/x-bzip2',
+    'xz': 'application/x-xz',
+}
+
+
+def guess_mimetype(filename):
+    mimetype, encoding = mimetypes.guess_type(filename)
+    if encoding:
+        return ENCODING_MIMETYPES.get(encoding, 'application/octet-stream')
+    return mimetype or 'application/octet-stream'
+
+
+def generate_attachments(attachments):
+    for attachment in attachments:
+        if os.path.isdir(attachment):
+            # Files in a directory are attached in order of their names, so
+            # the order in which files are omitted does not change
+            for filename in sorted(os.listdir(attachment)):
+                if filename.startswith('.'):
+                    continue
+                file_path = os.path.join(attachment, filename)
+                if os.path.isfile(file_path):
+                    yield file_path
+        else:
+            yield attachment
 
 
 class EmailMessage(object):
@@ -32,73 +73,94 @@ class EmailMessage(object):
                  message_type='plain',
                  message_encoding='us-ascii',
                  flowed=False,
-                 attach_errors=False):
-        self.to = self._addrs_to_list(to)
-        self.cc = self._addrs_to_list(cc)
-        self.bcc = self._addrs_to_list(bcc)
+                 attach_errors=False,
+                 attachment_cache=None,
+                 signer=None,
+                 metrics=None,
+                 groups=None,
+                 packer=None):
+        # Recipients included more than once are only kept in the first of
+        # the To, Cc and Bcc lists they appear in
+        self.to, self.cc, self.bcc = dedupe(
+            expand(self._addrs_to_list(to), groups),
+            expand(self._addrs_to_list(cc), groups),
+            expand(self._addrs_to_list(bcc), groups))
         self.sender = sender
         self.subject = subject
         self.email = MIMEMultipart()
         self.sign = sign
         self.sign_fallback = sign_fallback
         self.attach_errors = attach_errors
+        self.attachment_cache = attachment_cache
+        self.signer = signer
+        self.metrics = metrics or Metrics()
         self._errors = []
-        self._email_string = None
-        text = MIMEText(message, message_type, message_encoding)
-        if flowed:
-            old_content_type = text['Content-Type']
-            del text['Content-Type']
-            text['Content-Type'] = old_content_type + '; format="flowed"'
-        self.email.attach(text)
-        attach_errors_list = []
-        for filename in self._generate_attachments(attachments):
-            try:
-                self.attach_file(filename)
-            except:
-                if not self.attach_errors:
-                    raise
-                attach_errors_list.append(traceback.format_exc())
-        for attach_error in attach_errors_list:
-            self._attach_error(attach_error)
+        self._prepared = False
+        with self.metrics.stage('build') as stage:
+            attachments = list(generate_attachments(attachments))
+            if packer:
+                attachments, omitted = packer.pack(
+                    attachments, reserved=len(message.encode('UTF-8')))
+                if omitted:
+                    message = (self._manifest(omitted, packer.max_size) +
+                               message)
+            text = MIMEText(message, message_type, message_encoding)
+            if flowed:
+                old_content_type = text['Content-Type']
+                del text['Content-Type']
+                text['Content-Type'] = old_content_type + '; format="flowed"'
+            self.email.attach(text)
+            attach_errors_list = []
+            for filename in attachments:
+                try:
+                    self.attach_file(filename)
+                    stage.items += 1
+                except:
+                    if not self.attach_errors:
+                        raise
+                    attach_errors_list.append(traceback.format_exc())
+            for attach_error in attach_errors_list:
+                self._attach_error(attach_error)
 
     def __str__(self):
-        if not self._email_string:
-            if self.sign:
-                self._sign_message()
-            self.email['From'] = self.sender
-            self.email['To'] = self._addrs_to_str(self.to)
-            if self.cc:
-                self.email['Cc'] = self._addrs_to_str(self.cc)
-            if self.bcc:
-                self.email['Bcc'] = self._addrs_to_str(self.bcc)
-            self.email['Subject'] = self.subject
-            self._email_string = self.email.as_string()
-        return self._email_string
-
-    def _generate_attachments(self, attachments):
-        for attachment in attachments:
-            if os.path.isdir(attachment):
-                for filename in os.listdir(attachment):
-                    if filename.startswith('.'):
-                        continue
-                    file_path = os.path.join(attachment, filename)
-                    if os.path.isfile(file_path):
-                        yield file_path
-            else:
-                yield attachment
+        content = io.BytesIO()
+        self.write_to(content)
+        return content.getvalue().decode('UTF-8')
+
+    def _prepare(self):
+        if self._prepared:
+            return
+        if self.sign:
+            self._sign_message()
+        self.email['From'] = self.sender
+        self.email['To'] = self._addrs_to_str(self.to)
+        if self.cc:
+            self.email['Cc'] = self._addrs_to_str(self.cc)
+        self.email['Subject'] = self.subject
+        self._prepared = True
+
+    @property
+    def envelope_sender(self):
+        return parseaddr(self.sender)[1]
+
+    @property
+    def recipients(self):
+        # Bcc recipients are only included in the envelope, not the headers
+        return [address for name, address
+                in getaddresses(self.to + self.cc + self.bcc)]
+
+    def write_to(self, fp):
+        self._prepare()
+        write_message(self.email, fp)
 
     def attach_file(self, filename):
-        mimetype, encoding = mimetypes.guess_type(filename)
-        mimetype = mimetype or 'application/octet-stream'
-        mimetype = mimetype.split('/', 1)
-        fp = open(filename, 'rb')
-        attachment = MIMEBase(mimetype[0], mimetype[1])
-        attachment.set_payload(fp.read())
-        fp.close()
-        encode_base64(attachment)
-        attachment.add_header('Content-Disposition', 'attachment',
-                              filename=os.path.basename(filename))
-        self.email.attach(attachment)
+        if self.attachment_cache:
+            self.email.attach(self.attachment_cache.part(filename))
+            return
+        # Fail now if the file is not readable, rather than while sending
+        open(filename, 'rb').close()
+        self.email.attach(StreamedPart.from_file(guess_mimetype(filename),
+                                                 filename))
 
     def attach_text_as_file(self, text, filename='attachment.txt',
                             mimetype='text/plain'):
@@ -110,17 +172,19 @@ class EmailMessage(object):
                               filename=filename)
         self.email.attach(attachment)
 
-    def send(self):
-        content = str(self)
-        sendmail_process = subprocess.Popen(['/usr/sbin/sendmail', '-t',
-                                             '-f', self.sender],
-                                            stdin=subprocess.PIPE,
-                                            stdout=subprocess.PIPE,
-                                            stderr=subprocess.PIPE)
-        if not isinstance(content, bytes):
-            content = bytes(str(content), 'UTF-8')
-        sendmail_process.stdin.write(content)
-        return sendmail_process.communicate()
+    def attach_message_as_file(self, message, filename='message.txt',
+                               mimetype='text/plain'):
+        message_file = tempfile.TemporaryFile()
+        message.write_to(message_file)
+
+        def write_payload(fp):
+            message_file.seek(0)
+            shutil.copyfileobj(message_file, fp, READ_CHUNK_SIZE)
+
+        self.email.attach(StreamedPart(mimetype, filename, write_payload))
+
+    def send(self, transport=None):
+        return (transport or SendmailTransport()).send(self)
 
     def _addrs_to_list(self, addrs):
         if not addrs:
@@ -132,17 +196,10 @@ class EmailMessage(object):
 
     def _sign_message(self):
         try:
-            gnupg_dir = os.path.join(os.path.expanduser('~'), '.gnupg')
-            if not os.path.isdir(gnupg_dir):
-                raise Exception('{} does not exist'.format(gnupg_dir))
-            gnupg_options = []
-            if not sys.stdout.isatty():
-                gnupg_options.append('--pinentry-mode=cancel')
-            gpg = gnupg.GPG(gnupghome=gnupg_dir, options=gnupg_options)
-            text_to_sign = self.email.as_string().replace('\n', '\r\n')
-            signature = gpg.sign(text_to_sign, detach=True)
-            if not signature:
-                raise Exception('Email signature creation failed!')
+            signer = self.signer or Signer()
+            with self.metrics.stage('sign'):
+                signature = signer.sign(
+                    lambda fp: write_message(self.email, CRLFWriter(fp)))
             signature_attachment = Message()
             signature_attachment['Content-Type'] = \
                 'application/pgp-signature; name="signature.asc"'
@@ -169,6 +226,19 @@ class EmailMessage(object):
                     raise
             print('WARNING: {}'.format(e), file=sys.stderr)
 
+    def _manifest(self, omitted, max_size):
+        if max_size:
+            heading = ('The following attachment(s) were omitted to keep this '
+                       'message under {} bytes:'.format(max_size))
+        else:
+            heading = 'The following attachment(s) were omitted:'
+        lines = [heading, '']
+        for filename, size in omitted:
+            lines.append('* {} ({})'.format(
+                os.path.basename(filename),
+                'unreadable' if size is None else '{} bytes'.format(size)))
+        return os.linesep.join(lines + ['', '----', '', ''])
+
     def _attach_error(self, error):
         error_attachment = MIMEBase('text', 'plain')
         error_attachment.add_header('Content-Disposition', 'attachment',
@@ -0,0 +1,61 @@
+import errno
+import fcntl
+import os
+import time
+
+LOCK_FILE_NAME = 'alive.lock'
+DEFAULT_LOCK_TIMEOUT = 0
+LOCK_POLL_INTERVAL = 0.1
+
+
+class LockTimeout(Exception):
+    pass
+
+
+class RunLock(object):
+    def __init__(self, config_dir, timeout=DEFAULT_LOCK_TIMEOUT):
+        self._file_name = os.path.join(config_dir, LOCK_FILE_NAME)
+        self.timeout = timeout
+        self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def acquire(self):
+        # The lock is released by the kernel when the process holding it
+        # exits, so a lock can never be left behind by a crashed run
+        fd = os.open(self._file_name, os.O_RDWR | os.O_CREAT, 0o600)
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    os.close(fd)
+                    raise
+            if time.time() >= deadline:
+                holder = os.read(fd, 64).decode('UTF-8', 'replace').split()
+                os.close(fd)
+                message = 'Another run holds the lock {}'.format(
+                    self._file_name)
+                if len(holder) == 2 and holder[1].isdigit():
+                    message = '{} (PID {}, running since {})'.format(
+                        message, holder[0], time.ctime(float(holder[1])))
+                raise LockTimeout(message)
+            time.sleep(LOCK_POLL_INTERVAL)
+        os.ftruncate(fd, 0)
+        os.write(fd, '{} {}\n'.format(os.getpid(),
+                                      int(time.time())).encode('UTF-8'))
+        self._fd = fd
+
+    def release(self):
+        if self._fd is None:
+            return
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
@@ -1,25 +1,58 @@
 from __future__ import print_function
 
 import argparse
+import contextlib
+import hashlib
 import os
 import pwd
 import socket
 import sys
 import traceback
 
+from .archive import AttachmentPacker
+from .archive import DEFAULT_COMPRESSION_LEVEL
 from .config import Config
 from .config import DEFAULT_CONFIG_DIR
+from .daemon import Daemon
 from .email_message import EmailMessage
+from .lock import DEFAULT_LOCK_TIMEOUT
+from .lock import LockTimeout
+from .lock import RunLock
+from .message_cache import MessageCache
+from .metrics import DEFAULT_MAX_LOG_SIZE
+from .metrics import METRICS_LOG_FILE_NAME
+from .metrics import METRICS_TEXTFILE_NAME
+from .metrics import Metrics
+from .metrics import PROFILE_DIR_NAME
+from .metrics import profile
+from .outbox import Outbox
+from .signing import Signer
+from .state import StateStore
+from .tenants import DEFAULT_WORKERS
+from .tenants import TenantRunner
+from .tenants import shard
 from .sources import SOURCES
+from .sources import load_source
+from .transport import create_transport
 
 
 DEFAULT_EMAIL_SUBJECT = 'Safety information message'
+# Minimum number of seconds an interactive run waits for the run lock
+INTERACTIVE_LOCK_TIMEOUT = 60
 
 
 class Alive(object):
-    def __init__(self):
+    def __init__(self, clients=None):
         self.args = None
+        # Clients shared with other tenants in a multi-tenant run
+        self._clients = clients
         self._config = None
+        self._message_cache = None
+        self._transport = None
+        self._outbox = None
+        self._state = None
+        self._signer = None
+        self._metrics = None
 
     def _add_global_arguments(self, argument_parser):
         argument_parser.add_argument(
@@ -28,6 +61,14 @@ class Alive(object):
         argument_parser.add_argument(
             '-d', '--debug', action='store_true',
             help='Debug mode (don\'t send email)')
+        argument_parser.add_argument(
+            '--check-config', action='store_true',
+            help='Validate the configuration file and exit')
+        argument_parser.add_argument(
+            '--profile', action='store_true',
+            help=('Write cProfile and tracemalloc snapshots of this run to '
+                  'the {} subdirectory of the configuration directory'
+                  .format(PROFILE_DIR_NAME)))
 
     @property
     def config(self):
@@ -35,29 +76,223 @@ class Alive(object):
             self._config = Config(self.args.config_dir)
         return self._config
 
+    @property
+    def message_cache(self):
+        if not self._message_cache:
+            self._message_cache = MessageCache(self.args.config_dir)
+        return self._message_cache
+
+    @property
+    def transport(self):
+        if not self._transport:
+            settings = self._email_config().get('transport')
+            if self._clients:
+                self._transport = self._clients.get(
+                    'transport', settings,
+                    lambda: create_transport(settings))
+            else:
+                self._transport = create_transport(settings)
+        return self._transport
+
+    @property
+    def outbox(self):
+        if not self._outbox:
+            settings = (self.config.outbox if 'outbox' in self.config
+                        else None) or {}
+            self._outbox = Outbox(self.args.config_dir,
+                                  metrics=self.metrics, **settings)
+        return self._outbox
+
+    @property
+    def state(self):
+        if not self._state:
+            self._state = StateStore(self.args.config_dir)
+        return self._state
+
+    @property
+    def signer(self):
+        # The signer is kept across reloads, so the GPG session and the
+        # signature cache last for the lifetime of the process
+        if not self._signer:
+            if self._clients:
+                self._signer = self._clients.get('signer', None, Signer)
+            else:
+                self._signer = Signer()
+        return self._signer
+
+    @property
+    def metrics(self):
+        # Metrics are kept across reloads, so stages recorded before a reload
+        # are still written
+        if not self._metrics:
+            self._metrics = Metrics()
+        return self._metrics
+
+    def deliver_outbox(self):
+        try:
+            if self.args.debug:
+                return
+            for key, metadata in self.outbox.deliver(self.transport):
+                self.state.record_send(key, metadata['subject'],
+                                       metadata['created'])
+            self.state.commit()
+        finally:
+            self.write_metrics()
+
+    def write_metrics(self):
+        try:
+            settings = (self.config.metrics if 'metrics' in self.config
+                        else None) or {}
+            if not settings.get('enabled', True):
+                self.metrics.discard()
+                return
+            self.metrics.write(
+                self.state,
+                os.path.join(self.args.config_dir,
+                             settings.get('log_file', METRICS_LOG_FILE_NAME)),
+                os.path.join(self.args.config_dir,
+                             settings.get('textfile', METRICS_TEXTFILE_NAME)),
+                settings.get('max_log_size', DEFAULT_MAX_LOG_SIZE))
+        except Exception as e:
+            print('WARNING: Unable to write metrics: {}'.format(e),
+                  file=sys.stderr)
+
+    def lock(self, min_timeout=0):
+        settings = (self.config.lock if 'lock' in self.config
+                    else None) or {}
+        return RunLock(self.args.config_dir,
+                       max(settings.get('timeout', DEFAULT_LOCK_TIMEOUT),
+                           min_timeout))
+
+    def _profile(self):
+        if not self.args.profile:
+            # An empty ExitStack does nothing on entry or exit
+            return contextlib.ExitStack()
+        return profile(os.path.join(self.args.config_dir, PROFILE_DIR_NAME))
+
+    def reload(self):
+        self.close()
+        self._config = None
+        self._message_cache = None
+        self._outbox = None
+
+    def close(self):
+        if self._transport:
+            if not self._clients:
+                self._transport.close()
+            self._transport = None
+        if self._state:
+            self._state.close()
+            self._state = None
+
+    def check_config(self):
+        try:
+            Config(self.args.config_dir, use_cache=False)
+        except Exception as e:
+            print('Configuration error: {}'.format(e), file=sys.stderr)
+            return 1
+        print('Configuration OK')
+        return 0
+
+    def prepare(self):
+        profiles = [None] + list(self._email_config().get('profiles') or {})
+        files = self.message_cache.prepare(
+            [(self._attachments(profile), self._packer(profile))
+             for profile in profiles],
+            self._message_file())
+        print('Prepared outgoing message with {} attachment(s)'
+              .format(len(files)))
+
     def check(self):
         ap = argparse.ArgumentParser()
         self._add_global_arguments(ap)
-        # List loaded sources
-        loaded_sources = {
-            source.name: source
-            for source in SOURCES
-        }
         all_sources_choice = 'all'
         ap.add_argument('source', metavar='source',
                         nargs='*',
                         default=all_sources_choice,
-                        choices=([all_sources_choice] +
-                                 list(loaded_sources.keys())),
+                        choices=[all_sources_choice] + list(SOURCES),
                         help=('Source(s) to check (default: %(default)s, '
                               'choices: %(choices)s)'))
+        ap.add_argument('--daemon', action='store_true',
+                        help=('Run continuously, checking each source on '
+                              'its configured interval'))
+        ap.add_argument('--tenants', metavar='path',
+                        help=('Check each configuration directory within a '
+                              'directory, or listed in a manifest file, '
+                              'instead of --config-dir'))
+        ap.add_argument('--workers', metavar='count', type=int,
+                        default=DEFAULT_WORKERS,
+                        help=('Number of tenants to check at once '
+                              '(default: %(default)s)'))
+        ap.add_argument('--shard', metavar='index/count', type=shard,
+                        help=('Only check the tenants in shard index of '
+                              'count shards, numbered from 0'))
         self.args = ap.parse_args()
         if self.args.source == all_sources_choice:
-            self.args.source = loaded_sources
-        for source in self.args.source:
-            for source_text, is_test in \
-                    loaded_sources[source](self.config).check():
-                self._send_email(source_text, is_test)
+            self.args.source = list(SOURCES)
+        if self.args.tenants:
+            if self.args.daemon or self.args.profile:
+                ap.error('--daemon and --profile can not be used with '
+                         '--tenants')
+            return TenantRunner(self.args, Alive).run()
+        if self.args.check_config:
+            return self.check_config()
+        with self._profile():
+            try:
+                # Load the configuration before checking any source, so that
+                # configuration errors are reported first
+                self.config
+                if self.args.daemon:
+                    Daemon(self, [load_source(source)
+                                  for source in self.args.source]).run()
+                    return
+                errors = self.check_once(self.args.source)
+                for source, error in errors:
+                    print('Error checking source {}:'.format(source.name),
+                          file=sys.stderr)
+                    traceback.print_exception(type(error), error,
+                                              error.__traceback__)
+                return 1 if errors else 0
+            except LockTimeout as e:
+                print('Not checking sources: {}'.format(e), file=sys.stderr)
+                return 1
+            finally:
+                self.close()
+
+    def check_once(self, sources):
+        # Checks the named sources while holding the run lock, and returns
+        # (source, exception) for each source which failed. A source which
+        # cannot be created is reported by its class, without affecting the
+        # other sources.
+        with self.lock():
+            checked = []
+            errors = []
+            for source in sources:
+                source_class = load_source(source)
+                try:
+                    checked.append(source_class(self.config, self.state,
+                                                self.metrics, self._clients))
+                except Exception as e:
+                    errors.append((source_class, e))
+            return errors + self.check_sources(checked)
+
+    def check_source(self, source):
+        for failed_source, error in self.check_sources([source]):
+            raise error
+
+    def check_sources(self, sources):
+        # asyncio is only imported when sources are checked
+        from .runner import SourceRunner
+        return SourceRunner(self).run(sources)
+
+    def send_trigger(self, source, source_text, is_test, profile=None):
+        self._send_email(source_text, is_test,
+                         self._trigger_key(source, source_text, is_test),
+                         profile)
+
+    def _trigger_key(self, source, source_text, is_test):
+        return hashlib.sha256('{}\0{}\0{}'.format(
+            source.name, is_test, source_text).encode('UTF-8')).hexdigest()
 
     def main(self):
         ap = argparse.ArgumentParser()
@@ -67,7 +302,15 @@ class Alive(object):
                         help='Message to send')
         ap.add_argument('-t', '--test', dest='test', action='store_true',
                         help='Test (send outgoing message to sender only)')
+        ap.add_argument('-p', '--prepare', action='store_true',
+                        help=('Prepare the outgoing message ahead of time '
+                              'without sending it'))
         self.args = ap.parse_args()
+        if self.args.check_config:
+            return self.check_config()
+        if self.args.prepare:
+            self.prepare()
+            return
         user_name = pwd.getpwuid(os.getuid())[0]
         source_text = ('An interactive command run by the user {} on the '
                        'computer {}'
@@ -78,7 +321,22 @@ class Alive(object):
                 '',
                 ' '.join(self.args.message or '')
             ])
-        self._send_email(source_text, self.args.test)
+        with self._profile():
+            try:
+                # The message is spooled without the run lock, so it is never
+                # held up by a check in progress. Spooled messages are
+                # written atomically under unique keys, and are delivered by
+                # whichever run next delivers the outbox.
+                self._send_email(source_text, self.args.test)
+                try:
+                    with self.lock(INTERACTIVE_LOCK_TIMEOUT):
+                        self.deliver_outbox()
+                except LockTimeout as e:
+                    print('Message spooled, and will be delivered by a later '
+                          'run: {}'.format(e), file=sys.stderr)
+                    self.write_metrics()
+            finally:
+                self.close()
 
     def _prepend_to_message(self, message, prepend_text):
         return os.linesep.join([
@@ -89,10 +347,45 @@ class Alive(object):
             '{}',
         ]).format(message)
 
-    def _send_email(self, source_text, is_test=False):
+    def _email_config(self, profile=None):
         if 'email' not in self.config or not self.config.email:
             raise Exception('No email configuration present')
-        sender = self.config.email.get('from')
+        if not profile:
+            return self.config.email
+        profiles = self.config.email.get('profiles') or {}
+        if profile not in profiles:
+            raise Exception('Unknown message profile {}'.format(profile))
+        email_config = dict(self.config.email)
+        email_config.update({name: value
+                             for name, value in profiles[profile].items()
+                             if value is not None})
+        return email_config
+
+    def _attachments(self, profile=None):
+        attachments = self._email_config(profile).get('attachments') or []
+        if isinstance(attachments, str):
+            attachments = []
+        return list(attachments)
+
+    def _packer(self, profile=None):
+        email_config = self._email_config(profile)
+        if not (email_config.get('max_size') or email_config.get('archive')):
+            return None
+        return AttachmentPacker(
+            email_config.get('max_size'), email_config.get('archive'),
+            email_config.get('compression_level', DEFAULT_COMPRESSION_LEVEL),
+            self.message_cache)
+
+    def _message_file(self, profile=None):
+        message = self._email_config(profile).get('message', '').strip()
+        if len(message.splitlines()) == 1 and os.path.isfile(message):
+            return message
+        return None
+
+    def _send_email(self, source_text, is_test=False, key=None,
+                    profile=None):
+        email_config = self._email_config(profile)
+        sender = email_config.get('from')
         if not sender:
             raise Exception('Email sender is not configured')
         if is_test:
@@ -100,20 +393,20 @@ class Alive(object):
             cc = None
             bcc = None
         else:
-            to = self.config.email.get('to')
-            cc = self.config.email.get('cc')
-            bcc = self.config.email.get('bcc')
+            to = email_config.get('to')
+            cc = email_config.get('cc')
+            bcc = email_config.get('bcc')
         if not to:
             raise Exception('Email recipient(s) are not configured')
-        subject = self.config.email.get('subject', DEFAULT_EMAIL_SUBJECT)
+        subject = email_config.get('subject', DEFAULT_EMAIL_SUBJECT)
         if is_test:
             subject = '[TEST MESSAGE] {}'.format(subject)
-        attachments = self.config.email.get('attachments') or []
-        if isinstance(attachments, str):
-            attachments = []
-        message = self.config.email.get('message', '').strip()
-        if len(message.splitlines()) == 1 and os.path.isfile(message):
-            message = open(message, 'r').read().strip()
+        attachments = self._attachments(profile)
+        message_file = self._message_file(profile)
+        if message_file:
+            message = self.message_cache.message_text(message_file)
+        else:
+            message = email_config.get('message', '').strip()
         message = self._prepend_to_message(
             message,
             os.linesep.join(['This automatic message was triggered by:',
@@ -135,14 +428,22 @@ class Alive(object):
             flowed=True,
             sign=True,
             sign_fallback=True,
-            attach_errors=True
+            attach_errors=True,
+            attachment_cache=self.message_cache,
+            signer=self.signer,
+            metrics=self.metrics,
+            groups=email_config.get('groups'),
+            packer=self._packer(profile)
         )
+        spooling = False
         try:
             email = EmailMessage(**email_kwargs)
             if self.args.debug:
                 print(email)
             if not self.args.debug:
-                email.send()
+                spooling = True
+                self.outbox.put(email, key)
+                spooling = False
         except Exception:
             message = os.linesep.join(
                 [
@@ -160,8 +461,8 @@ class Alive(object):
             error_email = EmailMessage(**email_kwargs)
             try:
                 if email:
-                    error_email.attach_text_as_file(str(email),
-                                                    'original_message.txt')
+                    error_email.attach_message_as_file(
+                        email, 'original_message.txt')
             except Exception as e:
                 print('Exception attaching original message to error email: {}'
                       .format(e),
@@ -169,7 +470,12 @@ class Alive(object):
             if self.args.debug:
                 print(error_email)
             if not self.args.debug:
-                error_email.send()
+                error_email.send(self.transport)
+            if spooling:
+                # Nothing was spooled, so the failure is raised to keep the
+                # source from recording the trigger as processed, and the
+                # trigger is retried by the next check
+                raise
         finally:
             if not email:
                 raise Exception('No email message was generated!')
@@ -177,9 +483,9 @@ class Alive(object):
 
 def check():
     a = Alive()
-    a.check()
+    sys.exit(a.check())
 
 
 def main():
     a = Alive()
-    a.main()
+    sys.exit(a.main())
@@ -0,0 +1,199 @@
+import base64
+import hashlib
+import json
+import os
+import shutil
+
+from .archive import ARCHIVE_NAME
+from .archive import archive_names
+from .archive import compressed_size
+from .archive import write_archive
+from .config import CONFIG_FILE_NAME
+from .email_message import generate_attachments
+from .email_message import guess_mimetype
+from .message_stream import READ_CHUNK_SIZE
+from .message_stream import StreamedPart
+from .message_stream import copy_file
+
+CACHE_DIR_NAME = 'cache'
+INDEX_FILE_NAME = 'index.json'
+ENCODED_FILE_SUFFIX = '.b64'
+ARCHIVE_DIR_NAME = 'archives'
+# Changed when the index entries change, so older indexes are rebuilt
+INDEX_VERSION = 2
+
+
+class MessageCache(object):
+    def __init__(self, config_dir):
+        self._config_file = os.path.join(config_dir, CONFIG_FILE_NAME)
+        self._cache_dir = os.path.join(config_dir, CACHE_DIR_NAME)
+        self._index_file = os.path.join(self._cache_dir, INDEX_FILE_NAME)
+        self._archive_dir = os.path.join(self._cache_dir, ARCHIVE_DIR_NAME)
+        self._index = None
+        self._index_changed = False
+        self._message_text = {}
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = self._load_index()
+        return self._index
+
+    def prepare(self, attachment_sets, message_file=None):
+        # Each (attachments, packer) set is prepared as it will be attached,
+        # which with a packer may be as an archive or without some files
+        files = []
+        attached = []
+        for attachments, packer in attachment_sets:
+            set_files = list(generate_attachments(attachments))
+            set_attached = set_files
+            if packer:
+                set_attached, omitted = packer.pack(set_files)
+            files += [filename for filename in set_files
+                      if filename not in files]
+            attached += [filename for filename in set_attached
+                         if filename not in attached]
+        for filename in files:
+            self._entry(filename, encode=False)
+        for filename in attached:
+            self._entry(filename)
+        if message_file:
+            self.message_text(message_file)
+        # Prune entries, encoded files and archives no longer referenced
+        self.index['files'] = {
+            filename: entry
+            for filename, entry in self.index['files'].items()
+            if filename in files or filename in attached
+        }
+        in_use = {entry['sha256']
+                  for filename, entry in self.index['files'].items()
+                  if filename in attached}
+        for cached_file in os.listdir(self._cache_dir):
+            if not cached_file.endswith(ENCODED_FILE_SUFFIX):
+                continue
+            if cached_file[:-len(ENCODED_FILE_SUFFIX)] not in in_use:
+                os.remove(os.path.join(self._cache_dir, cached_file))
+        if os.path.isdir(self._archive_dir):
+            for archive_key in os.listdir(self._archive_dir):
+                archive_dir = os.path.join(self._archive_dir, archive_key)
+                if not any(os.path.dirname(filename) == archive_dir
+                           for filename in attached):
+                    shutil.rmtree(archive_dir)
+        self._save_index()
+        return attached
+
+    def archive(self, files, archive_format, level):
+        # Archives are cached by a digest of their format and the names and
+        # contents of the files in them
+        key = hashlib.sha256(json.dumps([
+            archive_format, level,
+            [[name, self._entry(filename, encode=False)['sha256']]
+             for filename, name in zip(files, archive_names(files))]
+        ]).encode('UTF-8')).hexdigest()
+        if self._index_changed:
+            self._save_index()
+        archive_dir = os.path.join(self._archive_dir, key)
+        archive_file = os.path.join(archive_dir, '{}.{}'.format(
+            ARCHIVE_NAME, archive_format))
+        if os.path.isfile(archive_file):
+            return archive_file
+        if not os.path.isdir(archive_dir):
+            os.makedirs(archive_dir)
+        temp_file = '{}.{}.tmp'.format(archive_file, os.getpid())
+        write_archive(temp_file, files, archive_format, level)
+        os.replace(temp_file, archive_file)
+        return archive_file
+
+    def remove_archive(self, archive_file):
+        shutil.rmtree(os.path.dirname(archive_file), ignore_errors=True)
+
+    def compressed_size(self, filename, archive_format, level):
+        entry = self._entry(filename, encode=False)
+        key = '{}:{}'.format(archive_format, level)
+        sizes = entry.setdefault('compressed', {})
+        if key not in sizes:
+            sizes[key] = compressed_size(filename, archive_format, level)
+            self._index_changed = True
+        return sizes[key]
+
+    def message_text(self, filename):
+        stat = os.stat(filename)
+        key = (filename, stat.st_size, stat.st_mtime_ns)
+        if key not in self._message_text:
+            self._message_text = {key: open(filename, 'r').read().strip()}
+        return self._message_text[key]
+
+    def part(self, filename):
+        entry = self._entry(filename)
+        if self._index_changed:
+            self._save_index()
+        encoded_file = self._encoded_file(entry['sha256'])
+        return StreamedPart(entry['mimetype'], os.path.basename(filename),
+                            lambda fp: copy_file(encoded_file, fp),
+                            encoded=True)
+
+    def _config_digest(self):
+        with open(self._config_file, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def _load_index(self):
+        config_digest = self._config_digest()
+        try:
+            with open(self._index_file, 'r') as f:
+                index = json.load(f)
+            if (index.get('config') == config_digest and
+                    index.get('version') == INDEX_VERSION):
+                return index
+        except (IOError, OSError, ValueError):
+            pass
+        if not os.path.isdir(self._cache_dir):
+            os.makedirs(self._cache_dir)
+        return {'config': config_digest, 'version': INDEX_VERSION,
+                'files': {}}
+
+    def _save_index(self):
+        # Temporary files are named by process, as the cache is shared with
+        # interactive runs which do not hold the run lock
+        temp_file = '{}.{}.tmp'.format(self._index_file, os.getpid())
+        with open(temp_file, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(temp_file, self._index_file)
+        self._index_changed = False
+
+    def _encoded_file(self, digest):
+        return os.path.join(self._cache_dir,
+                            '{}{}'.format(digest, ENCODED_FILE_SUFFIX))
+
+    def _entry(self, filename, encode=True):
+        # Files only included in archives are not encoded, but their digests
+        # are kept to find cached archives
+        stat = os.stat(filename)
+        entry = self.index['files'].get(filename)
+        if not (entry and entry['size'] == stat.st_size and
+                entry['mtime'] == stat.st_mtime_ns):
+            entry = {
+                'size': stat.st_size,
+                'mtime': stat.st_mtime_ns,
+                'sha256': self._digest(filename),
+                'mimetype': guess_mimetype(filename),
+            }
+            self.index['files'][filename] = entry
+            self._index_changed = True
+        if encode and not os.path.isfile(self._encoded_file(entry['sha256'])):
+            self._encode(filename, entry['sha256'])
+        return entry
+
+    def _digest(self, filename):
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _encode(self, filename, digest):
+        encoded_file = self._encoded_file(digest)
+        temp_file = '{}.{}.tmp'.format(encoded_file, os.getpid())
+        with open(filename, 'rb') as in_f, open(temp_file, 'wb') as out_f:
+            for chunk in iter(lambda: in_f.read(READ_CHUNK_SIZE), b''):
+                out_f.write(base64.encodebytes(chunk))
+        os.replace(temp_file, encoded_file)
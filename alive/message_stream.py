@@ -0,0 +1,113 @@
+import base64
+from email.generator import Generator
+from email.message import Message
+from email.mime.base import MIMEBase
+import io
+import os
+import random
+import sys
+
+# Multiple of 57 bytes, which base64 encodes to whole 76 character lines
+BASE64_LINE_BYTES = 57
+READ_CHUNK_SIZE = BASE64_LINE_BYTES * 1024 * 16
+NL = '\n'
+
+
+class Base64Writer(object):
+    def __init__(self, fp):
+        self._fp = fp
+        self._buffer = b''
+
+    def write(self, data):
+        data = self._buffer + data
+        length = len(data) - len(data) % BASE64_LINE_BYTES
+        if length:
+            self._fp.write(base64.encodebytes(data[:length]))
+        self._buffer = data[length:]
+
+    def close(self):
+        if self._buffer:
+            self._fp.write(base64.encodebytes(self._buffer))
+        self._buffer = b''
+
+
+class CRLFWriter(object):
+    def __init__(self, fp):
+        self._fp = fp
+
+    def write(self, data):
+        self._fp.write(data.replace(b'\n', b'\r\n'))
+
+
+class StreamedPart(MIMEBase):
+    def __init__(self, mimetype, filename, write_payload, encoded=False):
+        mimetype = mimetype.split('/', 1)
+        MIMEBase.__init__(self, mimetype[0], mimetype[1])
+        self['Content-Transfer-Encoding'] = 'base64'
+        self.add_header('Content-Disposition', 'attachment',
+                        filename=filename)
+        self._write_payload = write_payload
+        self._encoded = encoded
+
+    @classmethod
+    def from_file(cls, mimetype, filename, encoded=False):
+        return cls(mimetype, os.path.basename(filename),
+                   lambda fp: copy_file(filename, fp), encoded=encoded)
+
+    def write_body(self, fp):
+        if self._encoded:
+            self._write_payload(fp)
+            return
+        encoder = Base64Writer(fp)
+        self._write_payload(encoder)
+        encoder.close()
+
+
+def copy_file(filename, fp):
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+            fp.write(chunk)
+
+
+def _write_flattened(message, fp):
+    text = io.StringIO()
+    Generator(text, mangle_from_=False, maxheaderlen=0).flatten(message)
+    fp.write(text.getvalue().encode('UTF-8'))
+
+
+def _write_headers(message, fp):
+    headers = Message()
+    for key, value in message.items():
+        headers[key] = value
+    headers.set_payload('')
+    _write_flattened(headers, fp)
+
+
+def write_message(message, fp):
+    # Equivalent to email.generator.Generator.flatten, except that
+    # multipart bodies are not buffered and StreamedPart payloads are
+    # written to fp as they are read
+    if isinstance(message, StreamedPart):
+        _write_headers(message, fp)
+        message.write_body(fp)
+        return
+    if not message.is_multipart():
+        _write_flattened(message, fp)
+        return
+    boundary = message.get_boundary()
+    if not boundary:
+        # Same format as email.generator. Base64 encoded parts cannot
+        # contain the boundary, so it is not checked against the content.
+        boundary = '==============={:019d}=='.format(
+            random.randrange(sys.maxsize))
+        message.set_boundary(boundary)
+    _write_headers(message, fp)
+    if message.preamble is not None:
+        fp.write((message.preamble + NL).encode('UTF-8'))
+    for index, part in enumerate(message.get_payload()):
+        fp.write('{}--{}{}'.format(NL if index else '', boundary, NL)
+                 .encode('UTF-8'))
+        write_message(part, fp)
+    fp.write('{}--{}--{}'.format(NL, boundary, NL).encode('UTF-8'))
+    if message.epilogue is not None:
+        fp.write(message.epilogue.encode('UTF-8'))
@@ -0,0 +1,185 @@
+from __future__ import print_function
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+METRICS_LOG_FILE_NAME = 'metrics.log'
+METRICS_TEXTFILE_NAME = 'metrics.prom'
+PROFILE_DIR_NAME = 'profile'
+METRIC_PREFIX = 'alive_stage'
+# Size in bytes at which the metrics log is rotated, keeping one old log
+DEFAULT_MAX_LOG_SIZE = 10 * 1024 * 1024
+
+
+class Stage(object):
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.started = time.time()
+        self.duration = 0.0
+        self.outcome = 'ok'
+        self.bytes = 0
+        self.items = 0
+        self.retries = 0
+        self._paused = 0.0
+
+    @contextlib.contextmanager
+    def paused(self):
+        # Time spent outside of the stage (such as while a source's caller
+        # handles a yielded trigger) is not counted
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._paused += time.perf_counter() - start
+
+    def as_dict(self):
+        record = dict(self.labels)
+        record.update({
+            'time': self.started,
+            'stage': self.name,
+            'duration': self.duration,
+            'outcome': self.outcome,
+            'bytes': self.bytes,
+            'items': self.items,
+            'retries': self.retries,
+        })
+        return record
+
+
+class Metrics(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = []
+        # Totals of the stages recorded since they were last written
+        self._totals = {}
+
+    @contextlib.contextmanager
+    def stage(self, name, **labels):
+        stage = Stage(name, labels)
+        start = time.perf_counter()
+        try:
+            yield stage
+        except Exception:
+            stage.outcome = 'error'
+            raise
+        finally:
+            stage.duration = time.perf_counter() - start - stage._paused
+            self.record(stage)
+
+    def record(self, stage):
+        key = (stage.name, tuple(sorted(stage.labels.items())))
+        with self._lock:
+            self._pending.append(stage.as_dict())
+            totals = self._totals.setdefault(key, {
+                'count': 0,
+                'errors': 0,
+                'duration': 0.0,
+                'bytes': 0,
+                'items': 0,
+                'retries': 0,
+            })
+            totals['count'] += 1
+            totals['errors'] += stage.outcome != 'ok'
+            totals['duration'] += stage.duration
+            totals['bytes'] += stage.bytes
+            totals['items'] += stage.items
+            totals['retries'] += stage.retries
+            totals['last_duration'] = stage.duration
+            totals['last_run'] = stage.started
+
+    def discard(self):
+        with self._lock:
+            self._pending = []
+            self._totals = {}
+
+    def write(self, state, log_file=None, textfile=None,
+              max_log_size=DEFAULT_MAX_LOG_SIZE):
+        # Totals are added to those kept in the state store, so that the
+        # textfile covers every run, including runs from cron which each
+        # record only their own stages
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+            new_totals = self._totals
+            self._totals = {}
+        state.add_metric_totals(new_totals)
+        totals = sorted(state.metric_totals().items())
+        if log_file and pending:
+            if (max_log_size and os.path.isfile(log_file) and
+                    os.path.getsize(log_file) >= max_log_size):
+                os.replace(log_file, '{}.1'.format(log_file))
+            with open(log_file, 'a') as f:
+                for record in pending:
+                    f.write(json.dumps(record, sort_keys=True) + '\n')
+        if textfile:
+            # The file is replaced atomically, so the textfile collector never
+            # reads a partially written file
+            temp_file = '{}.{}.tmp'.format(textfile, os.getpid())
+            with open(temp_file, 'w') as f:
+                f.write(self._format_textfile(totals))
+            os.replace(temp_file, textfile)
+
+    def _format_textfile(self, totals):
+        metrics = [
+            ('duration_seconds_total', 'counter', 'duration',
+             'Total time spent in the stage'),
+            ('runs_total', 'counter', 'count',
+             'Number of times the stage ran'),
+            ('errors_total', 'counter', 'errors',
+             'Number of times the stage failed'),
+            ('bytes_total', 'counter', 'bytes',
+             'Number of bytes handled by the stage'),
+            ('items_total', 'counter', 'items',
+             'Number of items handled by the stage'),
+            ('retries_total', 'counter', 'retries',
+             'Number of retries handled by the stage'),
+            ('last_duration_seconds', 'gauge', 'last_duration',
+             'Duration of the last run of the stage'),
+            ('last_run_timestamp_seconds', 'gauge', 'last_run',
+             'Time of the last run of the stage'),
+        ]
+        lines = []
+        for suffix, metric_type, field, description in metrics:
+            name = '{}_{}'.format(METRIC_PREFIX, suffix)
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for (stage, labels), values in totals:
+                lines.append('{}{{{}}} {}'.format(
+                    name, self._format_labels((('stage', stage),) + labels),
+                    repr(float(values[field]))))
+        return '\n'.join(lines) + '\n'
+
+    def _format_labels(self, labels):
+        return ','.join(
+            '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                             .replace('"', '\\"').replace('\n', '\\n'))
+            for name, value in labels)
+
+
+@contextlib.contextmanager
+def profile(profile_dir):
+    # Only the main thread is profiled by cProfile, while tracemalloc traces
+    # allocations from all threads
+    import cProfile
+    import tracemalloc
+    if not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+    prefix = os.path.join(profile_dir, 'alive-{}-{}'.format(
+        time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        profiler.dump_stats('{}.prof'.format(prefix))
+        snapshot.dump('{}.tracemalloc'.format(prefix))
+        print('Wrote profile to {}.prof and {}.tracemalloc'
+              .format(prefix, prefix))
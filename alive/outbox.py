@@ -0,0 +1,213 @@
+from __future__ import print_function
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import shutil
+import sys
+import time
+import uuid
+
+from .message_stream import READ_CHUNK_SIZE
+from .metrics import Metrics
+
+OUTBOX_DIR_NAME = 'outbox'
+TEMP_DIR_NAME = 'tmp'
+MESSAGE_SUFFIX = '.eml'
+METADATA_SUFFIX = '.json'
+DEFAULT_RETRY_INTERVAL = 60
+DEFAULT_MAX_RETRY_INTERVAL = 3600
+DEFAULT_MAX_ENVELOPE_RECIPIENTS = 100
+DEFAULT_CONCURRENCY = 4
+# Seconds after which files left behind by an interrupted write are removed.
+# Interactive runs spool messages without holding the run lock, so files
+# which are still being written must not be removed.
+STALE_FILE_AGE = 3600
+
+
+class SpooledMessage(object):
+    def __init__(self, message_file, metadata, recipients=None):
+        self.message_file = message_file
+        self.metadata = metadata
+        self.envelope_sender = metadata['sender']
+        self.recipients = recipients or metadata['recipients']
+
+    def write_to(self, fp):
+        with open(self.message_file, 'rb') as f:
+            shutil.copyfileobj(f, fp, READ_CHUNK_SIZE)
+
+
+class Outbox(object):
+    def __init__(self, config_dir, retry_interval=DEFAULT_RETRY_INTERVAL,
+                 max_retry_interval=DEFAULT_MAX_RETRY_INTERVAL,
+                 max_envelope_recipients=DEFAULT_MAX_ENVELOPE_RECIPIENTS,
+                 concurrency=DEFAULT_CONCURRENCY, metrics=None):
+        self._outbox_dir = os.path.join(config_dir, OUTBOX_DIR_NAME)
+        self._temp_dir = os.path.join(self._outbox_dir, TEMP_DIR_NAME)
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.max_envelope_recipients = max(int(max_envelope_recipients), 1)
+        self.concurrency = max(int(concurrency), 1)
+        self.metrics = metrics or Metrics()
+        if not os.path.isdir(self._temp_dir):
+            os.makedirs(self._temp_dir)
+        self._compact()
+
+    def put(self, message, key=None):
+        key = key or uuid.uuid4().hex
+        metadata_file = self._file(key, METADATA_SUFFIX)
+        if os.path.isfile(metadata_file):
+            # Already spooled by an earlier run which did not record the
+            # trigger as processed
+            return False
+        with self.metrics.stage('spool') as stage:
+            self._write_atomic(self._file(key, MESSAGE_SUFFIX),
+                               message.write_to)
+            stage.bytes = os.path.getsize(self._file(key, MESSAGE_SUFFIX))
+        metadata = {
+            'sender': message.envelope_sender,
+            'recipients': message.recipients,
+            'subject': message.subject,
+            'created': time.time(),
+            'attempts': 0,
+            'next_attempt': 0,
+        }
+        self._write_metadata(key, metadata)
+        return True
+
+    def messages(self):
+        for file_name in sorted(os.listdir(self._outbox_dir)):
+            if not file_name.endswith(METADATA_SUFFIX):
+                continue
+            key = file_name[:-len(METADATA_SUFFIX)]
+            with open(self._file(key, METADATA_SUFFIX), 'r') as f:
+                metadata = json.load(f)
+            yield key, metadata
+
+    def next_attempt(self):
+        return min((metadata['next_attempt']
+                    for key, metadata in self.messages()), default=None)
+
+    def deliver(self, transport):
+        delivered = []
+        now = time.time()
+        for key, metadata in sorted(self.messages(),
+                                    key=lambda x: x[1]['created']):
+            if metadata['next_attempt'] > now:
+                continue
+            message_file = self._file(key, MESSAGE_SUFFIX)
+            recipients = metadata['recipients']
+            # Large recipient lists are split into multiple envelopes, which
+            # are sent concurrently
+            envelopes = [
+                recipients[i:i + self.max_envelope_recipients]
+                for i in range(0, len(recipients),
+                               self.max_envelope_recipients)
+            ]
+            with self.metrics.stage('send') as stage:
+                stage.bytes = os.path.getsize(message_file) * len(envelopes)
+                stage.retries = metadata['attempts']
+                refused, failed, error = self._send_envelopes(
+                    transport, message_file, metadata, envelopes)
+                stage.items = len(recipients) - len(refused) - len(failed)
+                if failed:
+                    stage.outcome = 'error'
+            for recipient, reply in refused.items():
+                print('WARNING: Recipient {} refused: {}'
+                      .format(recipient, reply), file=sys.stderr)
+            if failed:
+                # Only recipients whose envelopes failed are retried
+                metadata['recipients'] = failed
+                self._defer(key, metadata, error)
+                continue
+            self._remove(key)
+            delivered.append((key, metadata))
+        return delivered
+
+    def _send_envelopes(self, transport, message_file, metadata, envelopes):
+        def send(recipients):
+            try:
+                return transport.send(SpooledMessage(
+                    message_file, metadata, recipients)) or {}, None
+            except Exception as e:
+                return None, e
+
+        if len(envelopes) == 1:
+            results = [send(envelopes[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=min(
+                    self.concurrency, len(envelopes))) as executor:
+                results = list(executor.map(send, envelopes))
+        refused = {}
+        failed = []
+        error = None
+        for recipients, (envelope_refused, envelope_error) in zip(envelopes,
+                                                                  results):
+            if envelope_error:
+                failed += recipients
+                error = envelope_error
+            else:
+                refused.update(envelope_refused)
+        return refused, failed, error
+
+    def _defer(self, key, metadata, error):
+        metadata['attempts'] += 1
+        metadata['next_attempt'] = time.time() + min(
+            self.retry_interval * 2 ** (metadata['attempts'] - 1),
+            self.max_retry_interval)
+        self._write_metadata(key, metadata)
+        print('WARNING: Delivery of "{}" failed (attempt {}), '
+              'retrying after {}: {}'
+              .format(metadata['subject'], metadata['attempts'],
+                      time.ctime(metadata['next_attempt']), error),
+              file=sys.stderr)
+
+    def _file(self, key, suffix):
+        return os.path.join(self._outbox_dir, '{}{}'.format(key, suffix))
+
+    def _write_metadata(self, key, metadata):
+        self._write_atomic(
+            self._file(key, METADATA_SUFFIX),
+            lambda f: f.write(json.dumps(metadata).encode('UTF-8')))
+
+    def _write_atomic(self, file_name, write):
+        temp_file = os.path.join(self._temp_dir, os.path.basename(file_name))
+        with open(temp_file, 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, file_name)
+        self._sync_dir()
+
+    def _sync_dir(self):
+        dir_fd = os.open(self._outbox_dir, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def _remove(self, key):
+        # The metadata file is removed first, so a partially removed message
+        # is never delivered again
+        os.remove(self._file(key, METADATA_SUFFIX))
+        os.remove(self._file(key, MESSAGE_SUFFIX))
+        self._sync_dir()
+
+    def _compact(self):
+        # Remove files left behind by interrupted writes and removals
+        for file_name in os.listdir(self._temp_dir):
+            self._remove_stale(os.path.join(self._temp_dir, file_name))
+        for file_name in os.listdir(self._outbox_dir):
+            if not file_name.endswith(MESSAGE_SUFFIX):
+                continue
+            key = file_name[:-len(MESSAGE_SUFFIX)]
+            if not os.path.isfile(self._file(key, METADATA_SUFFIX)):
+                self._remove_stale(self._file(key, MESSAGE_SUFFIX))
+
+    def _remove_stale(self, file_name):
+        try:
+            if os.path.getmtime(file_name) < time.time() - STALE_FILE_AGE:
+                os.remove(file_name)
+        except FileNotFoundError:
+            # Moved into place or removed by another run
+            pass
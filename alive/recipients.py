@@ -0,0 +1,61 @@
+from email.utils import formataddr
+from email.utils import getaddresses
+
+FILE_PREFIX = 'file:'
+GROUP_PREFIX = 'group:'
+
+
+def read_addresses(file_name):
+    # Recipient files contain one or more addresses per line, and may
+    # contain blank lines and comments starting with #
+    with open(file_name, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
+
+
+def expand(entries, groups=None, parents=()):
+    # Yields the addresses of each entry, reading files and expanding groups
+    # as they are reached
+    for entry in entries:
+        entry = entry.strip()
+        if entry.startswith(FILE_PREFIX):
+            yield from read_addresses(entry[len(FILE_PREFIX):].strip())
+        elif entry.startswith(GROUP_PREFIX):
+            name = entry[len(GROUP_PREFIX):].strip()
+            if name in parents:
+                raise Exception('Recipient group {} includes itself'
+                                .format(name))
+            if not groups or name not in groups:
+                raise Exception('Unknown recipient group {}'.format(name))
+            members = groups[name]
+            if isinstance(members, str):
+                members = [members]
+            yield from expand(members, groups, parents + (name,))
+        elif entry:
+            yield entry
+
+
+def normalize(entries):
+    # Yields (formatted address, key) for each address, where the key is the
+    # lowercased address used to detect duplicates
+    for entry in entries:
+        for name, address in getaddresses([entry]):
+            if address:
+                yield formataddr((name, address)), address.lower()
+
+
+def dedupe(*address_lists):
+    # Returns each list with addresses already included in it or in an
+    # earlier list removed, so each recipient is only sent one copy
+    seen = set()
+    results = []
+    for addresses in address_lists:
+        result = []
+        for formatted, key in normalize(addresses):
+            if key not in seen:
+                seen.add(key)
+                result.append(formatted)
+        results.append(result)
+    return results
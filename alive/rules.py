@@ -0,0 +1,124 @@
+import re
+
+from .config import ConfigError
+
+ACTIONS = ['send', 'test', 'ignore']
+DEFAULT_ACTION = 'send'
+RULE_TYPES = ['keyword', 'phrase', 'regex']
+RULE_GROUP_PREFIX = '_rule'
+# Tokens of a regular expression outside and inside of a set, capturing the
+# group numbers of backreferences and conditional groups. Three octal digits
+# are a character escape rather than a backreference.
+REGEX_TOKEN = re.compile(
+    r'\\(?:[0-7]{3}|([1-9][0-9]?)|.)|\[\^?\]?|\(\?\(([0-9]+)\)|.', re.DOTALL)
+REGEX_SET_TOKEN = re.compile(r'\\.|.', re.DOTALL)
+
+
+def _numbered_references(regex):
+    # Group numbers referred to by a regular expression
+    references = []
+    pos = 0
+    in_set = False
+    while pos < len(regex):
+        if in_set:
+            match = REGEX_SET_TOKEN.match(regex, pos)
+            in_set = match.group() != ']'
+        else:
+            match = REGEX_TOKEN.match(regex, pos)
+            in_set = match.group().startswith('[')
+            references += [int(group) for group in match.groups() if group]
+        pos = match.end()
+    return references
+
+
+class Rule(object):
+    def __init__(self, rule_type, value, action=DEFAULT_ACTION,
+                 profile=None):
+        self.type = rule_type
+        self.value = value
+        self.action = action
+        self.profile = profile
+
+    @property
+    def pattern(self):
+        # Each pattern is matched from the start of the text, inside a
+        # lookahead of the combined expression
+        if self.type == 'regex':
+            return r'[\s\S]*?(?:{})'.format(self.value)
+        words = r'\s+'.join(re.escape(word) for word in self.value.split())
+        if self.type == 'keyword':
+            # The keyword must be the first word(s) of the text
+            return r'\s*{}(?!\S)'.format(words)
+        return r'[\s\S]*?(?<!\w){}(?!\w)'.format(words)
+
+
+class RuleSet(object):
+    def __init__(self, rules, path='triggers.rules'):
+        self.rules = [self._rule('{}[{}]'.format(path, i), rule)
+                      for i, rule in enumerate(rules)]
+        self._regex = None
+        if not self.rules:
+            return
+        # All rules are combined into a single expression, so each text is
+        # matched in one pass, with earlier rules taking precedence
+        alternatives = [
+            '(?={})(?P<{}{}>)'.format(rule.pattern, RULE_GROUP_PREFIX, i)
+            for i, rule in enumerate(self.rules)
+        ]
+        try:
+            self._regex = re.compile(
+                r'\A(?:{})'.format('|'.join(alternatives)), re.IGNORECASE)
+        except re.error as e:
+            raise ConfigError('{}: Error combining rules: {}'.format(path, e))
+
+    @classmethod
+    def from_keywords(cls, keywords):
+        # Rules matching the keyword(s) as the first word, with "test" as the
+        # second word selecting a test message
+        return cls([{'keyword': '{} test'.format(keyword), 'action': 'test'}
+                    for keyword in keywords] +
+                   [{'keyword': keyword} for keyword in keywords])
+
+    def _rule(self, path, rule):
+        if not isinstance(rule, dict):
+            raise ConfigError('{} must be a mapping'.format(path))
+        rule_types = [rule_type for rule_type in RULE_TYPES
+                      if rule_type in rule]
+        if len(rule_types) != 1:
+            raise ConfigError('{} must have exactly one of {}'
+                              .format(path, ', '.join(RULE_TYPES)))
+        for name in rule:
+            if name not in RULE_TYPES + ['action', 'profile']:
+                raise ConfigError('Unknown option {}.{}'.format(path, name))
+        rule_type = rule_types[0]
+        value = rule[rule_type]
+        if not isinstance(value, str) or not value.strip():
+            raise ConfigError('{}.{} must be a non-empty string'
+                              .format(path, rule_type))
+        if rule_type == 'regex':
+            try:
+                re.compile(value)
+            except re.error as e:
+                raise ConfigError('{}.regex is invalid: {}'.format(path, e))
+            # Groups are renumbered when rules are combined, so only named
+            # groups may be referred to
+            if _numbered_references(value):
+                raise ConfigError('{}.regex must refer to groups by name, '
+                                  'such as (?P=name), rather than by number'
+                                  .format(path))
+        action = rule.get('action', DEFAULT_ACTION)
+        if action not in ACTIONS:
+            raise ConfigError('{}.action must be one of {}'
+                              .format(path, ', '.join(ACTIONS)))
+        profile = rule.get('profile')
+        if profile is not None and not isinstance(profile, str):
+            raise ConfigError('{}.profile must be a string'.format(path))
+        return Rule(rule_type, value, action, profile)
+
+    def match(self, text):
+        if not self._regex:
+            return None
+        match = self._regex.match(text)
+        if not match:
+            return None
+        return self.rules[int(match.lastgroup[len(RULE_GROUP_PREFIX):])]
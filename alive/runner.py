@@ -0,0 +1,106 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_SOURCE_TIMEOUT = 300
+
+
+class SourceRunner(object):
+    def __init__(self, alive):
+        self._alive = alive
+        settings = (alive.config.sources if 'sources' in alive.config
+                    else None) or {}
+        self._timeout = settings.get('timeout', DEFAULT_SOURCE_TIMEOUT)
+        self._timeouts = settings.get('timeouts') or {}
+
+    def run(self, sources):
+        # Sources are checked concurrently, each with its own timeout, while
+        # their triggers are spooled one at a time from a queue. Returns a
+        # list of (source, exception) for the sources which failed.
+        loop = asyncio.new_event_loop()
+        loop.set_default_executor(
+            ThreadPoolExecutor(max_workers=len(sources) + 1))
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(self._check_sources(sources))
+        finally:
+            loop.close()
+            asyncio.set_event_loop(None)
+
+    async def _check_sources(self, sources):
+        loop = asyncio.get_event_loop()
+        triggers = asyncio.Queue()
+        delivery_lock = asyncio.Lock()
+        spooler = asyncio.ensure_future(self._spool_triggers(triggers))
+        try:
+            results = await asyncio.gather(
+                *[self._check_source(source, triggers, delivery_lock)
+                  for source in sources],
+                return_exceptions=True)
+        finally:
+            await triggers.put(None)
+            await spooler
+            # A trigger still being spooled when its source timed out is
+            # recorded and delivered once it has been spooled
+            async with delivery_lock:
+                await loop.run_in_executor(None, self._alive.state.commit)
+                await loop.run_in_executor(None, self._alive.deliver_outbox)
+        return [(source, result) for source, result in zip(sources, results)
+                if isinstance(result, Exception)]
+
+    async def _check_source(self, source, triggers, delivery_lock):
+        loop = asyncio.get_event_loop()
+        timeout = self._timeouts.get(source.name, self._timeout)
+        stage = None
+
+        async def emit(source_text, is_test, profile=None, processed=None):
+            stage.items += 1
+            spooled = loop.create_future()
+            await triggers.put((source, source_text, is_test, profile,
+                                processed, spooled))
+            await spooled
+
+        try:
+            with self._alive.metrics.stage('check',
+                                           source=source.name) as stage:
+                try:
+                    await asyncio.wait_for(source.check_async(emit), timeout)
+                except asyncio.TimeoutError:
+                    raise Exception('Checking source {} timed out after {} '
+                                    'seconds'.format(source.name, timeout))
+        finally:
+            # Triggers are only recorded as processed after their messages
+            # are spooled, so commit the source's state and then deliver
+            async with delivery_lock:
+                await loop.run_in_executor(None, self._alive.state.commit)
+                await loop.run_in_executor(None, self._alive.deliver_outbox)
+
+    async def _spool_triggers(self, triggers):
+        loop = asyncio.get_event_loop()
+        while True:
+            trigger = await triggers.get()
+            if trigger is None:
+                return
+            source, source_text, is_test, profile, processed, spooled = (
+                trigger)
+            if spooled.cancelled():
+                # The source timed out before the trigger was spooled
+                continue
+            try:
+                await loop.run_in_executor(
+                    None, self._spool_trigger, source, source_text, is_test,
+                    profile, processed)
+            except Exception as e:
+                if not spooled.cancelled():
+                    spooled.set_exception(e)
+            else:
+                if not spooled.cancelled():
+                    spooled.set_result(None)
+
+    def _spool_trigger(self, source, source_text, is_test, profile,
+                       processed):
+        self._alive.send_trigger(source, source_text, is_test, profile)
+        # The trigger is recorded as processed by the spooler rather than by
+        # the source, so it is recorded even if the source times out while
+        # the message is being spooled
+        if processed:
+            processed()
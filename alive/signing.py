@@ -0,0 +1,45 @@
+import os
+import sys
+import tempfile
+
+DEFAULT_GNUPG_DIR = os.path.join(os.path.expanduser('~'), '.gnupg')
+
+
+class Signature(object):
+    def __init__(self, data, hash_algo):
+        self.data = data
+        self.hash_algo = hash_algo
+
+    def __str__(self):
+        return self.data
+
+
+class Signer(object):
+    def __init__(self, gnupg_dir=DEFAULT_GNUPG_DIR):
+        self.gnupg_dir = gnupg_dir
+        self._gpg = None
+
+    @property
+    def gpg(self):
+        # The GPG instance (which runs gpg once to determine its version) is
+        # kept for the lifetime of the signer
+        if not self._gpg:
+            import gnupg
+            if not os.path.isdir(self.gnupg_dir):
+                raise Exception('{} does not exist'.format(self.gnupg_dir))
+            gnupg_options = []
+            if not sys.stdout.isatty():
+                gnupg_options.append('--pinentry-mode=cancel')
+            self._gpg = gnupg.GPG(gnupghome=self.gnupg_dir,
+                                  options=gnupg_options)
+        return self._gpg
+
+    def sign(self, write_content):
+        # The content is written once, to a temporary file for gpg to read
+        with tempfile.TemporaryFile() as content:
+            write_content(content)
+            content.seek(0)
+            result = self.gpg.sign_file(content, detach=True)
+        if not result:
+            raise Exception('Email signature creation failed!')
+        return Signature(str(result), result.hash_algo)
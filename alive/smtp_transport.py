@@ -0,0 +1,228 @@
+import re
+import smtplib
+import ssl
+import threading
+import time
+
+DEFAULT_HOST = 'localhost'
+DEFAULT_PORTS = {
+    'smtp': 25,
+    'smtps': 465,
+    'lmtp': 24,
+}
+DEFAULT_TIMEOUT = 60
+DEFAULT_POOL_SIZE = 2
+DEFAULT_IDLE_TIMEOUT = 60
+CRLF = b'\r\n'
+SMTP_DATA_CONTINUE = 354
+# Bytes of message data buffered before sending
+WRITE_BUFFER_SIZE = 64 * 1024
+
+
+class _DataWriter(object):
+    # Normalizes line endings to CRLF and dot-stuffs lines, as
+    # smtplib.SMTP.data() does, while the message is written. Data is sent in
+    # large chunks, with the end of data marker in the last one, so small
+    # writes are not held back waiting for the server to acknowledge them.
+    def __init__(self, connection):
+        self._connection = connection
+        self._pending = b''
+        self._line_start = True
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, data):
+        data = self._pending + data
+        self._pending = b''
+        if data.endswith(b'\r'):
+            data, self._pending = data[:-1], b'\r'
+        if not data:
+            return
+        data = re.sub(br'\r\n|\r|\n', CRLF, data)
+        if self._line_start and data.startswith(b'.'):
+            data = b'.' + data
+        data = data.replace(CRLF + b'.', CRLF + b'..')
+        self._line_start = data.endswith(CRLF)
+        self._send(data)
+
+    def close(self):
+        if self._pending:
+            self._send(CRLF)
+            self._line_start = True
+        if not self._line_start:
+            self._send(CRLF)
+        self._send(b'.' + CRLF)
+        self._flush()
+
+    def _send(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= WRITE_BUFFER_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            self._connection.send(b''.join(self._buffer))
+        self._buffer = []
+        self._buffered = 0
+
+
+class SMTPTransport(object):
+    def __init__(self, host=DEFAULT_HOST, port=None, protocol='smtp',
+                 tls=None, username=None, password=None,
+                 timeout=DEFAULT_TIMEOUT, pool_size=DEFAULT_POOL_SIZE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, local_hostname=None):
+        if protocol not in ('smtp', 'lmtp'):
+            raise Exception('Unknown mail transport protocol {}'
+                            .format(protocol))
+        if tls not in (None, 'starttls', 'ssl'):
+            raise Exception('Unknown TLS mode {}'.format(tls))
+        self.host = host
+        self.protocol = protocol
+        self.tls = tls
+        self.port = port or DEFAULT_PORTS[
+            'smtps' if tls == 'ssl' else protocol]
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.local_hostname = local_hostname
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        for attempt in range(2):
+            connection, reused = self._acquire()
+            try:
+                refused = self._transaction(connection, message)
+            except smtplib.SMTPServerDisconnected:
+                self._quit(connection)
+                # A pooled connection may have been closed by the server
+                # while idle, so retry once on a new connection
+                if reused and not attempt:
+                    continue
+                raise
+            except (smtplib.SMTPResponseException,
+                    smtplib.SMTPRecipientsRefused):
+                # The server rejected the transaction, but the connection
+                # is still usable
+                self._reset(connection)
+                self._release(connection)
+                raise
+            except Exception:
+                self._quit(connection)
+                raise
+            self._release(connection)
+            return refused
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, last_used in idle:
+            self._quit(connection)
+
+    def _connect(self):
+        if self.protocol == 'lmtp':
+            # smtplib.LMTP only accepts a timeout from Python 3.9, so it is
+            # set before connecting, and again on the socket for LMTP over a
+            # Unix socket
+            connection = smtplib.LMTP(local_hostname=self.local_hostname)
+            connection.timeout = self.timeout
+            connection.connect(self.host, self.port)
+            connection.sock.settimeout(self.timeout)
+        elif self.tls == 'ssl':
+            connection = smtplib.SMTP_SSL(
+                self.host, self.port, self.local_hostname,
+                timeout=self.timeout,
+                context=ssl.create_default_context())
+        else:
+            connection = smtplib.SMTP(self.host, self.port,
+                                      self.local_hostname,
+                                      timeout=self.timeout)
+        connection.ehlo()
+        if self.tls == 'starttls':
+            connection.starttls(context=ssl.create_default_context())
+            connection.ehlo()
+        if self.username:
+            connection.login(self.username, self.password or '')
+        return connection
+
+    def _acquire(self):
+        with self._lock:
+            while self._idle:
+                connection, last_used = self._idle.pop()
+                if time.time() - last_used < self.idle_timeout:
+                    return connection, True
+                self._quit(connection)
+        return self._connect(), False
+
+    def _release(self, connection):
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append((connection, time.time()))
+                return
+        self._quit(connection)
+
+    def _quit(self, connection):
+        try:
+            connection.quit()
+        except Exception:
+            connection.close()
+
+    def _transaction(self, connection, message):
+        recipients = message.recipients
+        commands = (
+            ['mail FROM:{}'.format(smtplib.quoteaddr(
+                message.envelope_sender))] +
+            ['rcpt TO:{}'.format(smtplib.quoteaddr(recipient))
+             for recipient in recipients] +
+            ['data']
+        )
+        if connection.has_extn('pipelining'):
+            connection.send(''.join('{}\r\n'.format(command)
+                                    for command in commands))
+            replies = [connection.getreply() for command in commands]
+        else:
+            replies = []
+            for command in commands:
+                connection.putcmd(command)
+                replies.append(connection.getreply())
+                if replies[0][0] != 250:
+                    break
+        code, response = replies[0]
+        if code != 250:
+            raise smtplib.SMTPSenderRefused(code, response,
+                                            message.envelope_sender)
+        refused = {
+            recipient: reply
+            for recipient, reply in zip(recipients, replies[1:])
+            if reply[0] not in (250, 251)
+        }
+        accepted = [recipient for recipient in recipients
+                    if recipient not in refused]
+        if not accepted:
+            raise smtplib.SMTPRecipientsRefused(refused)
+        code, response = replies[-1]
+        if code != SMTP_DATA_CONTINUE:
+            raise smtplib.SMTPDataError(code, response)
+        writer = _DataWriter(connection)
+        message.write_to(writer)
+        writer.close()
+        # LMTP returns a reply for each accepted recipient
+        for recipient in (accepted if self.protocol == 'lmtp'
+                          else accepted[:1]):
+            code, response = connection.getreply()
+            if code != 250:
+                if self.protocol != 'lmtp':
+                    raise smtplib.SMTPDataError(code, response)
+                refused[recipient] = (code, response)
+        if len(refused) == len(recipients):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        return refused
+
+    def _reset(self, connection):
+        try:
+            connection.rset()
+        except smtplib.SMTPException:
+            pass
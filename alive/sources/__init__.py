@@ -1,7 +1,15 @@
-from .periodic_test import PeriodicTest
-from .twitter import Twitter
+import importlib
 
-SOURCES = [
-    PeriodicTest,
-    Twitter,
-]
+# Sources are imported by name when used, so that checking one source does
+# not import the dependencies of every other source
+SOURCES = {
+    'periodic_test': 'periodic_test.PeriodicTest',
+    'twitter': 'twitter.Twitter',
+    'webhook': 'webhook.Webhook',
+}
+
+
+def load_source(name):
+    module_name, class_name = SOURCES[name].rsplit('.', 1)
+    module = importlib.import_module('.{}'.format(module_name), __name__)
+    return getattr(module, class_name)
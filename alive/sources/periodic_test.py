@@ -27,8 +27,13 @@ class PeriodicTest(Source):
             return
         last_checked = self._last_checked
         now = int(time.time())
-        if last_checked:
-            if now <= (last_checked + self._interval):
-                return
-            yield DEFAULT_MESSAGE, True
-        self._last_checked = now
+        if not last_checked:
+            self._last_checked = now
+            return
+        if now <= (last_checked + self._interval):
+            return
+
+        def processed():
+            self._last_checked = now
+
+        yield DEFAULT_MESSAGE, True, None, processed
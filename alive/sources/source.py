@@ -3,10 +3,24 @@ from __future__ import print_function
 import abc
 import os
 
+from ..metrics import Metrics
+from ..rules import RuleSet
+
+DEFAULT_KEYWORD = 'alive'
+
 
 class Source(object):
-    def __init__(self, config):
+    # Push sources receive triggers in the background while the daemon runs,
+    # rather than only when checked
+    push = False
+
+    def __init__(self, config, state, metrics=None, clients=None):
         self.config = config
+        self.state = state
+        self.metrics = metrics or Metrics()
+        # Clients shared with other tenants in a multi-tenant run
+        self.clients = clients
+        self._rules = None
         self._timestamp_file = os.path.join(self.config._config_dir,
                                             '{}.timestamp'.format(self.name))
 
@@ -14,8 +28,93 @@ class Source(object):
     def check(self):
         pass
 
+    def start(self, notify):
+        # Called by the daemon for push sources, which call notify() from any
+        # thread when triggers are waiting to be checked
+        pass
+
+    def stop(self):
+        pass
+
+    @property
+    def rules(self):
+        # Trigger rules from the configuration apply to all sources, and
+        # otherwise each source may provide its own
+        if self._rules is None:
+            settings = (self.config.triggers if 'triggers' in self.config
+                        else None) or {}
+            if settings.get('rules'):
+                self._rules = RuleSet(settings['rules'])
+            else:
+                self._rules = self.default_rules()
+        return self._rules
+
+    def default_rules(self):
+        return RuleSet([])
+
+    @property
+    def coalesce_window(self):
+        settings = (self.config.triggers if 'triggers' in self.config
+                    else None) or {}
+        return settings.get('coalesce_window', 0)
+
+    def _coalesce(self, matches, created):
+        # Groups consecutive (item, rule) matches with the same action and
+        # profile, which were created within the coalescing window of the
+        # first match in the group, so they are sent as one message
+        group = []
+        for item, rule in matches:
+            if group and (not self.coalesce_window or
+                          rule.action != group[0][1].action or
+                          rule.profile != group[0][1].profile or
+                          created(item) - created(group[0][0]) >
+                          self.coalesce_window):
+                yield group
+                group = []
+            group.append((item, rule))
+        if group:
+            yield group
+
+    def _list(self, value):
+        return list(value) if isinstance(value, (list, tuple)) else [value]
+
+    def _combine(self, source_texts):
+        if len(source_texts) == 1:
+            return source_texts[0]
+        return os.linesep.join(
+            ['{} triggers:'.format(len(source_texts))] +
+            ['* {}'.format(source_text) for source_text in source_texts])
+
+    async def check_async(self, emit):
+        # Sources may override this to check asynchronously, awaiting
+        # emit(source_text, is_test, profile=None, processed=None) for each
+        # trigger, where processed() records the trigger as processed once
+        # its message has been spooled. Synchronous sources are adapted by
+        # running check() in a worker thread, resuming it only after each
+        # trigger's message has been spooled.
+        import asyncio
+        loop = asyncio.get_event_loop()
+        triggers = self.check()
+        while True:
+            trigger = await loop.run_in_executor(None, next, triggers, None)
+            if trigger is None:
+                return
+            await emit(*trigger)
+
     @property
     def _last_checked(self):
+        last_checked = self.state.get(self.name, 'last_checked')
+        if last_checked is None:
+            last_checked = self._legacy_last_checked()
+            self._last_checked = last_checked
+        return last_checked
+
+    @_last_checked.setter
+    def _last_checked(self, new_value):
+        self.state.set(self.name, 'last_checked', new_value)
+
+    def _legacy_last_checked(self):
+        # Timestamp file used before the state store was added
         if not os.path.isfile(self._timestamp_file):
             return 0
         with open(self._timestamp_file, 'r') as f:
@@ -26,8 +125,3 @@ class Source(object):
                 print('Error: Invalid timestamp "{}" in file {}'
                       .format(first_line, self._timestamp_file))
                 return 0
-
-    @_last_checked.setter
-    def _last_checked(self, new_value):
-        with open(self._timestamp_file, 'w') as f:
-            print(new_value, file=f)
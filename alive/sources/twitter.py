@@ -1,14 +1,34 @@
-import twitter
+import calendar
+from email.utils import parsedate
+import heapq
 
+from .source import DEFAULT_KEYWORD
 from .source import Source
+from ..rules import RuleSet
+from .twitter_api import DEFAULT_MAX_BACKFILL
+from .twitter_api import DEFAULT_PAGE_SIZE
+from .twitter_api import RateLimit
+from .twitter_api import TimelineClient
 from ..util import epoch_time_to_datetime
 
 
-DEFAULT_KEYWORD = 'alive'
-MAX_TWEETS = 10
 TWEET_URL_FORMAT = 'https://twitter.com/statuses/{}'
 
 
+class Tweet(object):
+    # The fields of a status used by the source, so the rest of the status
+    # can be freed as soon as its page has been read
+    __slots__ = ['id_str', 'created_at_in_seconds', 'full_text',
+                 'screen_name']
+
+    def __init__(self, status):
+        self.id_str = status['id_str']
+        self.created_at_in_seconds = calendar.timegm(
+            parsedate(status['created_at']))
+        self.full_text = status.get('full_text', status.get('text', ''))
+        self.screen_name = status['user']['screen_name']
+
+
 class Twitter(Source):
     name = 'twitter'
 
@@ -27,8 +47,15 @@ class Twitter(Source):
         if not self.keywords:
             raise Exception('No Twitter keyword(s) are configured')
 
-    def _list(self, value):
-        return list(value) if isinstance(value, (list, tuple)) else [value]
+    def default_rules(self):
+        return RuleSet.from_keywords(self.keywords)
+
+    def _legacy_last_checked(self):
+        # The timestamp file held the time of the last processed tweet, and
+        # tweets sent at that time were skipped, so tweets are migrated as
+        # processed up to the end of that second
+        last_checked = super(Twitter, self)._legacy_last_checked()
+        return last_checked + 1 if last_checked else 0
 
     @property
     def _client(self):
@@ -40,31 +67,155 @@ class Twitter(Source):
                     raise Exception('Missing Twitter configuration value {}'
                                     .format(arg))
                 api_args.update({arg: self.config.twitter[arg]})
-            self._twitter = twitter.Api(tweet_mode='extended', **api_args)
+            for arg in ['api_url', 'concurrency', 'timeout']:
+                if arg in self.config.twitter:
+                    api_args.update({arg: self.config.twitter[arg]})
+            rate_limit_args = {}
+            for arg in ['reserve', 'max_wait']:
+                config_arg = 'rate_limit_{}'.format(arg)
+                if config_arg in self.config.twitter:
+                    rate_limit_args[arg] = self.config.twitter[config_arg]
+
+            def create():
+                return TimelineClient(rate_limit=RateLimit(**rate_limit_args),
+                                      **api_args)
+
+            if self.clients:
+                # Tenants with the same credentials share a client, and with
+                # it their connections and the API rate limit
+                self._twitter = self.clients.get(
+                    'twitter', [api_args, rate_limit_args], create)
+            else:
+                self._twitter = create()
         return self._twitter
 
     def check(self):
-        tweets = []
-        for username in self.usernames:
-            tweets += self._client.GetUserTimeline(screen_name=username,
-                                                   count=MAX_TWEETS)
-        for tweet in sorted(tweets, key=lambda x: x.created_at_in_seconds):
-            if tweet.created_at_in_seconds <= self._last_checked:
+        # Only tweets after each user's cursor are fetched, along with any
+        # gaps left by earlier checks which reached the backfill limit
+        cursors = {username: self._cursor(username)
+                   for username in self.usernames}
+        requests = []
+        for username, cursor in cursors.items():
+            requests.append((username, cursor.get('since_id'), None))
+            requests += [(username,) + tuple(gap)
+                         for gap in self._gaps(cursor)]
+        with self.metrics.stage('fetch', source=self.name) as stage:
+            received_bytes = self._client.received_bytes
+            timelines = self._client.user_timelines(
+                requests,
+                self.config.twitter.get('page_size', DEFAULT_PAGE_SIZE),
+                self.config.twitter.get('max_backfill', DEFAULT_MAX_BACKFILL))
+            stage.bytes = self._client.received_bytes - received_bytes
+            stage.items = sum(timeline.fetched for timeline in timelines)
+        # Later pages are fetched as the merged timelines are filtered
+        with self.metrics.stage('filter', source=self.name) as stage:
+            received_bytes = self._client.received_bytes
+            uncursored = {username.lower() for username, cursor
+                          in cursors.items()
+                          if cursor.get('since_id') is None}
+            for trigger in self._filter(self._merge(timelines), uncursored,
+                                        stage):
+                yield trigger
+            stage.bytes = self._client.received_bytes - received_bytes
+        # Cursors are only moved once the triggers have been spooled, so an
+        # interrupted check fetches the same tweets again
+        for username, cursor in cursors.items():
+            self._update_cursor(username, cursor, timelines)
+
+    def _merge(self, timelines):
+        # Each timeline's pages are latest first, so they are merged latest
+        # first, reading one page of each timeline at a time
+        return heapq.merge(
+            *[self._tweets(timeline) for timeline in timelines],
+            key=lambda tweet: (tweet.created_at_in_seconds,
+                               int(tweet.id_str)),
+            reverse=True)
+
+    def _tweets(self, timeline):
+        for page in timeline:
+            for status in page:
+                yield Tweet(status)
+
+    def _cursor(self, username):
+        return self.state.get(self.name,
+                              'cursor:{}'.format(username.lower())) or {}
+
+    def _gaps(self, cursor):
+        # Cursors written before gaps were kept separately hold a single gap
+        if cursor.get('gap'):
+            return [cursor['gap']]
+        return cursor.get('gaps', [])
+
+    def _update_cursor(self, username, cursor, timelines):
+        since_id = cursor.get('since_id')
+        gaps = []
+        for timeline in timelines:
+            if timeline.screen_name != username:
+                continue
+            if timeline.max_id is None and timeline.latest_id is not None:
+                since_id = timeline.latest_id
+            if not timeline.complete:
+                # Tweets older than those fetched are fetched by later
+                # checks
+                gaps.append([timeline.since_id, timeline.earliest_id - 1])
+        if gaps:
+            print('WARNING: Reached the backfill limit fetching tweets from '
+                  '{}; older tweets will be fetched by later checks'
+                  .format(username))
+        new_cursor = {'since_id': since_id}
+        if gaps:
+            # Gaps are kept separately, rather than merged into one range,
+            # so tweets between them are not fetched and filtered again
+            new_cursor['gaps'] = sorted(gaps, key=lambda gap: gap[1],
+                                        reverse=True)
+        if new_cursor != cursor and since_id is not None:
+            self.state.set(self.name, 'cursor:{}'.format(username.lower()),
+                           new_cursor)
+
+    def _filter(self, tweets, uncursored, stage):
+        usernames = [username.lower() for username in self.usernames]
+        last_checked = self._last_checked
+        matches = []
+        for tweet in tweets:
+            stage.items += 1
+            screen_name = tweet.screen_name.lower()
+            # Without a cursor, tweets from before the last processed tweet
+            # are skipped. Tweets sent in the same second as the last
+            # processed tweet are told apart by their IDs.
+            if (screen_name in uncursored and
+                    tweet.created_at_in_seconds < last_checked):
+                continue
+            if self.state.is_processed(self.name, tweet.id_str):
                 continue
-            if tweet.user.screen_name.lower() != username.lower():
+            if screen_name not in usernames:
                 continue
 
-            tweet_keyword, tweet_action = tweet.full_text.split(' ', 1)
-            if tweet_keyword.strip().lower() not in self.keywords:
+            rule = self.rules.match(tweet.full_text)
+            if not rule or rule.action == 'ignore':
+                self.state.mark_processed(self.name, tweet.id_str)
                 continue
-            is_test = (tweet_action and
-                       tweet_action.split()[0].lower() == 'test')
-            source_text = ('A Tweet sent at {} by {}: "{}" ({})'
-                           .format(
-                               epoch_time_to_datetime(
-                                   tweet.created_at_in_seconds),
-                               tweet.user.screen_name,
-                               tweet.full_text,
-                               TWEET_URL_FORMAT.format(tweet.id_str)))
-            yield source_text, is_test
+            matches.append((tweet, rule))
+        # Triggers are sent in the order the tweets were sent
+        matches.reverse()
+        for group in self._coalesce(
+                matches, lambda tweet: tweet.created_at_in_seconds):
+            rule = group[0][1]
+            source_text = self._combine([self._source_text(tweet)
+                                         for tweet, rule in group])
+            with stage.paused():
+                yield (source_text, rule.action == 'test', rule.profile,
+                       lambda group=group: self._processed(group))
+
+    def _processed(self, group):
+        for tweet, rule in group:
+            self.state.mark_processed(self.name, tweet.id_str)
+        # Tweets fetched from a gap are older than those already processed
+        if tweet.created_at_in_seconds > self._last_checked:
             self._last_checked = tweet.created_at_in_seconds
+
+    def _source_text(self, tweet):
+        return ('A Tweet sent at {} by {}: "{}" ({})'
+                .format(epoch_time_to_datetime(tweet.created_at_in_seconds),
+                        tweet.screen_name,
+                        tweet.full_text,
+                        TWEET_URL_FORMAT.format(tweet.id_str)))
@@ -0,0 +1,182 @@
+from __future__ import print_function
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests_oauthlib import OAuth1
+
+DEFAULT_API_URL = 'https://api.twitter.com/1.1'
+DEFAULT_CONCURRENCY = 4
+DEFAULT_TIMEOUT = 30
+DEFAULT_RATE_LIMIT_RESERVE = 1
+DEFAULT_RATE_LIMIT_MAX_WAIT = 60
+# The maximum number of tweets the API returns in one page
+DEFAULT_PAGE_SIZE = 200
+DEFAULT_MAX_BACKFILL = 800
+USER_TIMELINE_PATH = '/statuses/user_timeline.json'
+HTTP_TOO_MANY_REQUESTS = 429
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+class RateLimit(object):
+    def __init__(self, reserve=DEFAULT_RATE_LIMIT_RESERVE,
+                 max_wait=DEFAULT_RATE_LIMIT_MAX_WAIT):
+        self.reserve = reserve
+        self.max_wait = max_wait
+        self.remaining = None
+        self.reset = None
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        # Holding the lock while waiting for the window to reset also holds
+        # back any other requests queued behind this one
+        with self._lock:
+            if self.reset is not None and self.reset <= time.time():
+                self.remaining = None
+                self.reset = None
+            if self.remaining is None:
+                return
+            if self.remaining > self.reserve:
+                self.remaining -= 1
+                return
+            wait = self.reset - time.time()
+            if wait > self.max_wait:
+                raise RateLimitExceeded(
+                    'Twitter API rate limit nearly exhausted ({} requests '
+                    'remaining), deferring until {}'
+                    .format(self.remaining, time.ctime(self.reset)))
+            time.sleep(max(wait, 0))
+            self.remaining = None
+            self.reset = None
+
+    def update(self, headers):
+        remaining = headers.get('x-rate-limit-remaining')
+        reset = headers.get('x-rate-limit-reset')
+        if remaining is None or reset is None:
+            return
+        try:
+            remaining = int(remaining)
+            reset = int(reset)
+        except ValueError:
+            return
+        with self._lock:
+            # Responses to concurrent requests may arrive out of order, so
+            # keep the lowest remaining count seen within the same window
+            if reset == self.reset and self.remaining is not None:
+                remaining = min(remaining, self.remaining)
+            self.remaining = remaining
+            self.reset = reset
+
+
+class TimelineClient(object):
+    def __init__(self, consumer_key, consumer_secret, access_token_key,
+                 access_token_secret, api_url=DEFAULT_API_URL,
+                 concurrency=DEFAULT_CONCURRENCY, timeout=DEFAULT_TIMEOUT,
+                 rate_limit=None):
+        self._auth = OAuth1(consumer_key, consumer_secret,
+                            access_token_key, access_token_secret)
+        self._api_url = api_url.rstrip('/')
+        self._concurrency = max(int(concurrency), 1)
+        self._timeout = timeout
+        self.rate_limit = rate_limit or RateLimit()
+        self.received_bytes = 0
+        self._received_lock = threading.Lock()
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self._concurrency)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
+    def user_timeline(self, screen_name, count, since_id=None, max_id=None):
+        params = dict(screen_name=screen_name, count=count,
+                      tweet_mode='extended')
+        if since_id is not None:
+            params['since_id'] = since_id
+        if max_id is not None:
+            params['max_id'] = max_id
+        self.rate_limit.acquire()
+        response = self._session.get(
+            self._api_url + USER_TIMELINE_PATH,
+            params=params,
+            auth=self._auth,
+            timeout=self._timeout)
+        self.rate_limit.update(response.headers)
+        with self._received_lock:
+            self.received_bytes += len(response.content)
+        if response.status_code == HTTP_TOO_MANY_REQUESTS:
+            raise RateLimitExceeded('Twitter API rate limit exceeded')
+        response.raise_for_status()
+        return response.json()
+
+    def user_timelines(self, requests, page_size=DEFAULT_PAGE_SIZE,
+                       max_tweets=DEFAULT_MAX_BACKFILL):
+        # Returns TimelinePages for each (screen_name, since_id, max_id)
+        # request, with their first pages fetched concurrently
+        timelines = [TimelinePages(self, *request, page_size=page_size,
+                                   max_tweets=max_tweets)
+                     for request in requests]
+        with ThreadPoolExecutor(max_workers=self._concurrency) as executor:
+            list(executor.map(lambda timeline: timeline.prefetch(),
+                              timelines))
+        return timelines
+
+    def close(self):
+        self._session.close()
+
+
+class TimelinePages(object):
+    # Iterates over the pages of a user's timeline, latest first, paging
+    # backward from max_id (or the latest tweet) until reaching since_id, or
+    # until max_tweets have been fetched. Each page is only fetched once the
+    # previous one has been consumed. Without since_id, only the latest page
+    # is fetched.
+    def __init__(self, client, screen_name, since_id=None, max_id=None,
+                 page_size=DEFAULT_PAGE_SIZE,
+                 max_tweets=DEFAULT_MAX_BACKFILL):
+        self._client = client
+        self.screen_name = screen_name
+        self.since_id = since_id
+        self.max_id = max_id
+        self._page_max_id = max_id
+        self._page_size = page_size
+        self._max_tweets = max_tweets
+        self._next_page = None
+        self.fetched = 0
+        self.latest_id = None
+        self.earliest_id = None
+        # Once all pages are fetched, whether all tweets after since_id were
+        # fetched without reaching max_tweets
+        self.complete = None
+
+    def prefetch(self):
+        self._next_page = self._fetch()
+
+    def __iter__(self):
+        while self.complete is None or self._next_page is not None:
+            page = self._next_page
+            self._next_page = None
+            yield page if page is not None else self._fetch()
+
+    def _fetch(self):
+        count = min(self._page_size, self._max_tweets - self.fetched)
+        page = self._client.user_timeline(self.screen_name, count,
+                                          self.since_id, self._page_max_id)
+        self.fetched += len(page)
+        if page:
+            ids = [tweet['id'] for tweet in page]
+            self.latest_id = max([self.latest_id or 0] + ids)
+            self.earliest_id = min(ids)
+        # A short page is the last one
+        if self.since_id is None or len(page) < count:
+            self.complete = True
+        elif self.fetched >= self._max_tweets:
+            self.complete = False
+        else:
+            self._page_max_id = self.earliest_id - 1
+        return page
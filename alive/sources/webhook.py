@@ -0,0 +1,121 @@
+from __future__ import print_function
+
+import queue
+import threading
+import time
+import uuid
+
+from .source import DEFAULT_KEYWORD
+from .source import Source
+from ..rules import RuleSet
+from ..util import epoch_time_to_datetime
+
+DEFAULT_QUEUE_SIZE = 100
+
+
+class Webhook(Source):
+    name = 'webhook'
+    push = True
+
+    def __init__(self, *args, **kwargs):
+        super(Webhook, self).__init__(*args, **kwargs)
+        self.settings = (self.config.webhook if 'webhook' in self.config
+                         else None) or {}
+        self.keywords = [
+            keyword.strip().lower() for keyword in
+            self._list(self.settings.get('keyword', DEFAULT_KEYWORD))
+        ]
+        self._queue = queue.Queue(self.settings.get('queue_size',
+                                                    DEFAULT_QUEUE_SIZE))
+        # Events taken from the queue which have not been processed yet
+        self._events = []
+        self._notify = None
+        self._server = None
+
+    def default_rules(self):
+        return RuleSet.from_keywords(self.keywords)
+
+    def start(self, notify):
+        # Events are only received while the daemon runs, and without any
+        # configuration the source does nothing
+        if not self.settings:
+            return
+        # The HTTP server is only imported when receiving events
+        from .webhook_server import create_server
+        self._notify = notify
+        self._server = create_server(self.settings, self._receive)
+        threading.Thread(target=self._server.serve_forever,
+                         name='webhook', daemon=True).start()
+        print('Receiving webhook events at {}'.format(self._server.address))
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _receive(self, text, event_id):
+        # Called from the server thread with each verified event. Returns
+        # False if the queue is full.
+        if event_id is None:
+            # Without an ID from the sender, every event is a new one, so
+            # two alerts with the same text are both checked
+            event_id = uuid.uuid4().hex
+        else:
+            event_id = 'id:{}'.format(event_id)
+        event = (event_id, time.time(), text)
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            return False
+        self._notify()
+        return True
+
+    def check(self):
+        while True:
+            try:
+                self._events.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        with self.metrics.stage('filter', source=self.name) as stage:
+            stage.items = len(self._events)
+            for trigger in self._filter(stage):
+                yield trigger
+
+    def _filter(self, stage):
+        # A request repeating the ID of an earlier event, such as a gateway
+        # retrying a callback, does not trigger another message
+        matches = []
+        event_ids = set()
+        for event in list(self._events):
+            event_id, received, text = event
+            if event_id in event_ids:
+                # Repeats an event which is already being checked
+                self._events.remove(event)
+                continue
+            event_ids.add(event_id)
+            rule = None
+            if not self.state.is_processed(self.name, event_id):
+                rule = self.rules.match(text)
+            if not rule or rule.action == 'ignore':
+                self.state.mark_processed(self.name, event_id)
+                self._events.remove(event)
+                continue
+            matches.append((event, rule))
+        for group in self._coalesce(matches, lambda event: event[1]):
+            rule = group[0][1]
+            source_text = self._combine([self._source_text(event)
+                                         for event, rule in group])
+            with stage.paused():
+                yield (source_text, rule.action == 'test', rule.profile,
+                       lambda group=group: self._processed(group))
+
+    def _processed(self, group):
+        for event, rule in group:
+            self.state.mark_processed(self.name, event[0])
+            self._events.remove(event)
+
+    def _source_text(self, event):
+        event_id, received, text = event
+        return ('A webhook event received at {}: "{}"'
+                .format(epoch_time_to_datetime(int(received)), text))
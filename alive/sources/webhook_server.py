@@ -0,0 +1,256 @@
+import hashlib
+import hmac
+import http.server
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+from urllib.parse import parse_qs
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8025
+DEFAULT_PATH = '/'
+DEFAULT_SIGNATURE_HEADER = 'X-Signature'
+DEFAULT_TIMESTAMP_HEADER = 'X-Timestamp'
+# Seconds a signed request is valid for, either side of its timestamp
+DEFAULT_MAX_AGE = 300
+DEFAULT_TEXT_FIELD = 'text'
+DEFAULT_ID_FIELD = 'id'
+DEFAULT_MAX_BODY_SIZE = 64 * 1024
+DEFAULT_MAX_CONNECTIONS = 8
+SIGNATURE_PREFIX = 'sha256='
+# Seconds a client may take to send a whole request, so that slow clients
+# cannot hold on to a connection
+REQUEST_TIMEOUT = 5
+UNIX_SOCKET_MODE = 0o600
+
+
+class WebhookHandler(http.server.BaseHTTPRequestHandler):
+    timeout = REQUEST_TIMEOUT
+
+    def handle(self):
+        # The socket timeout only limits each read, so the connection is also
+        # closed once the request as a whole has taken too long
+        timer = threading.Timer(REQUEST_TIMEOUT, self._expire)
+        timer.start()
+        try:
+            http.server.BaseHTTPRequestHandler.handle(self)
+        finally:
+            timer.cancel()
+
+    def _expire(self):
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def do_POST(self):
+        # Requests are rejected as cheaply as possible: the body is only read
+        # if it is signed and not too large, and only parsed once the
+        # signature has been verified
+        receiver = self.server.receiver
+        if self.path.split('?', 1)[0] != receiver.path:
+            self._respond(404)
+            return
+        signature = self.headers.get(receiver.signature_header, '').strip()
+        if not signature.startswith(SIGNATURE_PREFIX):
+            self._respond(401)
+            return
+        signature = signature[len(SIGNATURE_PREFIX):].lower()
+        timestamp = self.headers.get(receiver.timestamp_header, '').strip()
+        if not receiver.current(timestamp):
+            self._respond(401)
+            return
+        try:
+            length = int(self.headers.get('Content-Length', ''))
+        except ValueError:
+            self._respond(411)
+            return
+        if not 0 <= length <= receiver.max_body_size:
+            self._respond(413)
+            return
+        body = self.rfile.read(length)
+        if not receiver.verify(timestamp, body, signature):
+            self._respond(401)
+            return
+        try:
+            text, event_id = receiver.parse(body,
+                                            self.headers.get_content_type())
+        except ValueError:
+            self._respond(400)
+            return
+        if not receiver.accept(signature, int(timestamp), text, event_id):
+            # The queue is full, so the sender should retry later
+            self._respond(503)
+            return
+        self._respond(202)
+
+    def _respond(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        # Rejected requests are not logged, so that a flood of junk requests
+        # does not also flood the log
+        pass
+
+
+class WebhookReceiver(object):
+    def __init__(self, settings, receive):
+        self.receive = receive
+        self.path = settings.get('path', DEFAULT_PATH)
+        self.signature_header = settings.get('signature_header',
+                                             DEFAULT_SIGNATURE_HEADER)
+        self.text_field = settings.get('text_field', DEFAULT_TEXT_FIELD)
+        self.id_field = settings.get('id_field', DEFAULT_ID_FIELD)
+        self.timestamp_header = settings.get('timestamp_header',
+                                             DEFAULT_TIMESTAMP_HEADER)
+        self.max_age = settings.get('max_age', DEFAULT_MAX_AGE)
+        self.max_body_size = settings.get('max_body_size',
+                                          DEFAULT_MAX_BODY_SIZE)
+        self._secret = settings['secret'].encode('UTF-8')
+        # Signatures of accepted requests, with their timestamps, kept until
+        # the requests are too old to be replayed
+        self._accepted = {}
+        self._lock = threading.Lock()
+
+    def current(self, timestamp):
+        # Whether a request's timestamp, in seconds since the epoch, is
+        # within max_age of the time it is received
+        try:
+            timestamp = int(timestamp)
+        except ValueError:
+            return False
+        return abs(time.time() - timestamp) <= self.max_age
+
+    def verify(self, timestamp, body, signature):
+        # The timestamp is signed along with the body, so a captured request
+        # cannot be sent again with a later timestamp
+        expected = hmac.new(self._secret,
+                            timestamp.encode('UTF-8') + b'.' + body,
+                            hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected.encode('ascii'),
+                                   signature.encode('UTF-8'))
+
+    def accept(self, signature, timestamp, text, event_id):
+        # Receives the event of a verified request, unless the same request
+        # was already accepted. Returns False if the queue is full.
+        with self._lock:
+            now = time.time()
+            self._accepted = {
+                accepted: accepted_timestamp for accepted, accepted_timestamp
+                in self._accepted.items()
+                if accepted_timestamp + self.max_age >= now
+            }
+            if signature in self._accepted:
+                return True
+            if not self.receive(text, event_id):
+                return False
+            self._accepted[signature] = timestamp
+            return True
+
+    def parse(self, body, content_type):
+        # Returns the text of a JSON, form encoded or plain text event, and
+        # its ID if the sender gave one
+        try:
+            body = body.decode('UTF-8')
+        except UnicodeDecodeError:
+            raise ValueError('Event is not valid UTF-8')
+        if content_type == 'application/json':
+            event = json.loads(body)
+            if not isinstance(event, dict):
+                event = {}
+        elif content_type == 'application/x-www-form-urlencoded':
+            event = {name: values[-1]
+                     for name, values in parse_qs(body).items()}
+        else:
+            event = {self.text_field: body}
+        text = event.get(self.text_field)
+        if not isinstance(text, str) or not text.strip():
+            raise ValueError('Event has no text')
+        event_id = event.get(self.id_field)
+        if isinstance(event_id, bool) or not isinstance(event_id,
+                                                        (str, int)):
+            event_id = None
+        return text.strip(), event_id
+
+
+class BoundedThreadingMixIn(socketserver.ThreadingMixIn):
+    # Handles requests in threads, at most max_connections at a time.
+    # Connections beyond that are closed at once, so the sender retries
+    # later.
+    daemon_threads = True
+
+    def _start_workers(self, max_connections):
+        self._workers = threading.BoundedSemaphore(max_connections)
+
+    def process_request(self, request, client_address):
+        if not self._workers.acquire(blocking=False):
+            self.shutdown_request(request)
+            return
+        try:
+            socketserver.ThreadingMixIn.process_request(self, request,
+                                                        client_address)
+        except Exception:
+            self._workers.release()
+            raise
+
+    def handle_error(self, request, client_address):
+        # Connections closed by the client, or once the request timeout has
+        # passed, are not logged
+        if not isinstance(sys.exc_info()[1], OSError):
+            super(BoundedThreadingMixIn, self).handle_error(request,
+                                                            client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            socketserver.ThreadingMixIn.process_request_thread(
+                self, request, client_address)
+        finally:
+            self._workers.release()
+
+
+class WebhookServer(BoundedThreadingMixIn, http.server.HTTPServer):
+    def __init__(self, address, receiver, max_connections):
+        self.receiver = receiver
+        self._start_workers(max_connections)
+        http.server.HTTPServer.__init__(self, address, WebhookHandler)
+        self.address = 'http://{}:{}{}'.format(
+            address[0], self.server_address[1], receiver.path)
+
+
+class UnixWebhookServer(BoundedThreadingMixIn,
+                        socketserver.UnixStreamServer):
+    def __init__(self, socket_file, receiver, max_connections):
+        self.receiver = receiver
+        self._start_workers(max_connections)
+        self.address = 'unix:{}'.format(socket_file)
+        if os.path.exists(socket_file):
+            # Left behind by an earlier run
+            os.remove(socket_file)
+        socketserver.UnixStreamServer.__init__(self, socket_file,
+                                               WebhookHandler)
+        os.chmod(socket_file, UNIX_SOCKET_MODE)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def create_server(settings, receive):
+    # At most max_connections requests are handled at a time, each within a
+    # timeout, which bounds the resources a flood of requests can use
+    receiver = WebhookReceiver(settings, receive)
+    max_connections = settings.get('max_connections',
+                                   DEFAULT_MAX_CONNECTIONS)
+    if settings.get('socket'):
+        return UnixWebhookServer(settings['socket'], receiver,
+                                 max_connections)
+    return WebhookServer((settings.get('host', DEFAULT_HOST),
+                          settings.get('port', DEFAULT_PORT)), receiver,
+                         max_connections)
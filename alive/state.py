@@ -0,0 +1,159 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+STATE_FILE_NAME = 'state.db'
+# Number of processed item IDs remembered for each source
+MAX_PROCESSED_IDS = 1000
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS cursors (
+        source TEXT NOT NULL,
+        name TEXT NOT NULL,
+        value TEXT NOT NULL,
+        PRIMARY KEY (source, name))''',
+    '''CREATE TABLE IF NOT EXISTS processed (
+        source TEXT NOT NULL,
+        id TEXT NOT NULL,
+        processed REAL NOT NULL,
+        PRIMARY KEY (source, id))''',
+    '''CREATE TABLE IF NOT EXISTS sends (
+        key TEXT NOT NULL,
+        subject TEXT,
+        created REAL,
+        sent REAL NOT NULL)''',
+    '''CREATE TABLE IF NOT EXISTS metric_totals (
+        stage TEXT NOT NULL,
+        labels TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        errors INTEGER NOT NULL DEFAULT 0,
+        duration REAL NOT NULL DEFAULT 0,
+        bytes INTEGER NOT NULL DEFAULT 0,
+        items INTEGER NOT NULL DEFAULT 0,
+        retries INTEGER NOT NULL DEFAULT 0,
+        last_duration REAL NOT NULL DEFAULT 0,
+        last_run REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (stage, labels))''',
+]
+# Fields of the metric totals which are added up across runs, rather than
+# replaced by the latest run
+METRIC_COUNTERS = ['count', 'errors', 'duration', 'bytes', 'items', 'retries']
+METRIC_GAUGES = ['last_duration', 'last_run']
+
+
+class StateStore(object):
+    def __init__(self, config_dir):
+        self._file_name = os.path.join(config_dir, STATE_FILE_NAME)
+        # Sources are checked concurrently from worker threads, so changes
+        # are made and committed while holding the lock
+        self._connection = sqlite3.connect(self._file_name,
+                                           check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._connection:
+            for statement in SCHEMA:
+                self._connection.execute(statement)
+        self._cursors = {
+            (source, name): json.loads(value)
+            for source, name, value in self._connection.execute(
+                'SELECT source, name, value FROM cursors')
+        }
+        self._processed = {}
+        for source, item_id in self._connection.execute(
+                'SELECT source, id FROM processed'):
+            self._processed.setdefault(source, set()).add(item_id)
+        self._changed_cursors = {}
+        self._new_processed = []
+        self._new_sends = []
+
+    def get(self, source, name, default=None):
+        return self._cursors.get((source, name), default)
+
+    def set(self, source, name, value):
+        with self._lock:
+            self._cursors[(source, name)] = value
+            self._changed_cursors[(source, name)] = value
+
+    def is_processed(self, source, item_id):
+        return item_id in self._processed.get(source, ())
+
+    def mark_processed(self, source, item_id):
+        with self._lock:
+            if self.is_processed(source, item_id):
+                return
+            self._processed.setdefault(source, set()).add(item_id)
+            self._new_processed.append((source, item_id, time.time()))
+
+    def record_send(self, key, subject, created):
+        with self._lock:
+            self._new_sends.append((key, subject, created, time.time()))
+
+    def add_metric_totals(self, totals):
+        # Totals are added to in the database, rather than written from
+        # memory, so totals from runs in other processes are kept
+        with self._lock, self._connection:
+            for (stage, labels), values in totals.items():
+                key = (stage, json.dumps(labels))
+                self._connection.execute(
+                    'INSERT OR IGNORE INTO metric_totals (stage, labels) '
+                    'VALUES (?, ?)', key)
+                self._connection.execute(
+                    'UPDATE metric_totals SET {} WHERE stage = ? AND '
+                    'labels = ?'.format(', '.join(
+                        ['{0} = {0} + ?'.format(name)
+                         for name in METRIC_COUNTERS] +
+                        ['{} = ?'.format(name) for name in METRIC_GAUGES])),
+                    [values[name] for name in METRIC_COUNTERS] +
+                    [values[name] for name in METRIC_GAUGES] + list(key))
+
+    def metric_totals(self):
+        fields = METRIC_COUNTERS + METRIC_GAUGES
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT stage, labels, {} FROM metric_totals'
+                .format(', '.join(fields))).fetchall()
+        return {
+            (row[0], tuple(tuple(label) for label in json.loads(row[1]))):
+            dict(zip(fields, row[2:]))
+            for row in rows
+        }
+
+    def commit(self):
+        with self._lock:
+            self._commit()
+
+    def _commit(self):
+        if not (self._changed_cursors or self._new_processed or
+                self._new_sends):
+            return
+        with self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO cursors (source, name, value) '
+                'VALUES (?, ?, ?)',
+                [(source, name, json.dumps(value))
+                 for (source, name), value in self._changed_cursors.items()])
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO processed (source, id, processed) '
+                'VALUES (?, ?, ?)', self._new_processed)
+            self._connection.executemany(
+                'INSERT INTO sends (key, subject, created, sent) '
+                'VALUES (?, ?, ?, ?)', self._new_sends)
+            for source in {item[0] for item in self._new_processed}:
+                self._connection.execute(
+                    'DELETE FROM processed WHERE source = ? AND id NOT IN '
+                    '(SELECT id FROM processed WHERE source = ? '
+                    'ORDER BY processed DESC LIMIT ?)',
+                    (source, source, MAX_PROCESSED_IDS))
+                self._processed[source] = {
+                    item_id for item_id, in self._connection.execute(
+                        'SELECT id FROM processed WHERE source = ?',
+                        (source,))
+                }
+        self._changed_cursors = {}
+        self._new_processed = []
+        self._new_sends = []
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,128 @@
+from __future__ import print_function
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import os
+import sys
+import threading
+import traceback
+import zlib
+
+from .clients import SharedClients
+from .config import CONFIG_FILE_NAME
+from .config import Config
+from .config import ConfigError
+from .lock import LockTimeout
+
+DEFAULT_WORKERS = 8
+
+
+def tenant_dirs(path):
+    # Tenants are the configuration directories within a directory, or are
+    # listed in a manifest file, one per line relative to the manifest, with
+    # blank lines and lines starting with # ignored
+    if os.path.isdir(path):
+        return sorted(
+            os.path.join(path, name) for name in os.listdir(path)
+            if os.path.isfile(os.path.join(path, name, CONFIG_FILE_NAME)))
+    manifest_dir = os.path.dirname(os.path.abspath(path))
+    config_dirs = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                config_dirs.append(os.path.join(manifest_dir,
+                                                os.path.expanduser(line)))
+    return config_dirs
+
+
+def shard(value):
+    # Parses a shard argument of the form index/count
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'must be index/count, not {}'.format(value))
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(
+            'index must be from 0 to count - 1, not {}'.format(index))
+    return index, count
+
+
+def in_shard(config_dir, index, count):
+    # Tenants are assigned to shards by their path, so each keeps its shard
+    # as tenants are added and removed
+    path = os.path.abspath(config_dir).encode('UTF-8')
+    return zlib.crc32(path) % count == index
+
+
+class TenantRunner(object):
+    def __init__(self, args, alive_class):
+        self.args = args
+        self._alive_class = alive_class
+        self.clients = SharedClients()
+        self._output_lock = threading.Lock()
+
+    def run(self):
+        tenants = tenant_dirs(self.args.tenants)
+        if self.args.shard:
+            tenants = [tenant for tenant in tenants
+                       if in_shard(tenant, *self.args.shard)]
+        check = (self._check_config if self.args.check_config
+                 else self._check_tenant)
+        try:
+            with ThreadPoolExecutor(max_workers=self.args.workers) as executor:
+                results = list(executor.map(check, tenants))
+        finally:
+            self.clients.close()
+        failed = results.count(False)
+        print('Checked {} tenant(s), {} failed'.format(len(tenants), failed))
+        return 1 if failed else 0
+
+    def _check_tenant(self, config_dir):
+        # Each tenant has its own configuration, state, outbox, run lock and
+        # metrics, and shares only clients with identical settings. Errors
+        # are reported without affecting other tenants.
+        alive = self._alive_class(clients=self.clients)
+        alive.args = copy.copy(self.args)
+        alive.args.config_dir = config_dir
+        try:
+            errors = alive.check_once(self.args.source)
+        except ConfigError as e:
+            self._report(config_dir, 'Configuration error: {}'.format(e))
+            return False
+        except LockTimeout as e:
+            self._report(config_dir, 'Not checking sources: {}'.format(e))
+            return False
+        except Exception as e:
+            self._report(config_dir, 'Error checking sources:', e)
+            return False
+        finally:
+            alive.close()
+        for source, error in errors:
+            self._report(config_dir,
+                         'Error checking source {}:'.format(source.name),
+                         error)
+        return not errors
+
+    def _check_config(self, config_dir):
+        try:
+            Config(config_dir, use_cache=False)
+        except Exception as e:
+            self._report(config_dir, 'Configuration error: {}'.format(e))
+            return False
+        return True
+
+    def _report(self, config_dir, message, error=None):
+        lines = [message]
+        if error is not None:
+            lines += traceback.format_exception(type(error), error,
+                                                error.__traceback__)
+        # Each report is written at once, so reports from tenants checked at
+        # the same time are not interleaved
+        with self._output_lock:
+            print(''.join('{}: {}\n'.format(config_dir, line)
+                          for text in lines
+                          for line in text.rstrip('\n').split('\n')),
+                  end='', file=sys.stderr)
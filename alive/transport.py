@@ -0,0 +1,43 @@
+import importlib
+import subprocess
+
+DEFAULT_SENDMAIL_PATH = '/usr/sbin/sendmail'
+
+
+class SendmailTransport(object):
+    def __init__(self, path=DEFAULT_SENDMAIL_PATH):
+        self.path = path
+
+    def send(self, message):
+        # With -i, a line containing only a dot does not end the message
+        sendmail_process = subprocess.Popen(
+            [self.path, '-i', '-f', message.envelope_sender, '--'] +
+            message.recipients,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        message.write_to(sendmail_process.stdin)
+        stdout, stderr = sendmail_process.communicate()
+        if sendmail_process.returncode:
+            raise Exception('{} exited with status {}: {}'
+                            .format(self.path, sendmail_process.returncode,
+                                    stderr.decode('UTF-8', 'replace')
+                                    .strip()))
+        return {}
+
+    def close(self):
+        pass
+
+
+def create_transport(settings):
+    settings = dict(settings or {})
+    transport_type = settings.pop('type', 'sendmail')
+    if transport_type == 'sendmail':
+        return SendmailTransport(**settings)
+    if transport_type in ('smtp', 'lmtp'):
+        # smtplib and ssl are only imported when an SMTP transport is used
+        smtp_transport = importlib.import_module('.smtp_transport',
+                                                 __package__)
+        return smtp_transport.SMTPTransport(protocol=transport_type,
+                                            **settings)
+    raise Exception('Unknown email transport type {}'.format(transport_type))
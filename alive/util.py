@@ -1,8 +1,7 @@
 import datetime
-import pytz
-import tzlocal
 
 
-def epoch_time_to_datetime(epoch_time, tzinfo=tzlocal.get_localzone()):
-    return (datetime.datetime.utcfromtimestamp(epoch_time)
-            .replace(tzinfo=pytz.utc).astimezone(tzinfo))
+def epoch_time_to_datetime(epoch_time, tzinfo=None):
+    # Converts to the local time zone if tzinfo is not specified
+    return (datetime.datetime.fromtimestamp(epoch_time, datetime.timezone.utc)
+            .astimezone(tzinfo))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Measure cold start import time of the alive entry points using
+"python -X importtime", failing if it exceeds the budget or if dependencies
+which should be imported lazily are imported at startup.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_RUNS = 7
+DEFAULT_BUDGET_MS = 200
+ENTRY_POINTS = {
+    'alive': ['alive.main'],
+    'alive-check periodic_test': ['alive.main',
+                                  'alive.sources.periodic_test'],
+}
+LAZY_MODULES = [
+    'gnupg',
+    'pytz',
+    'requests',
+    'smtplib',
+    'ssl',
+    'tarfile',
+    'tzlocal',
+    'yaml',
+    'zipfile',
+]
+
+
+def measure(modules):
+    process = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c',
+         'import {}'.format(', '.join(modules))],
+        cwd=REPO_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    stdout, stderr = process.communicate()
+    if process.returncode:
+        raise Exception('Import failed: {}'.format(stderr))
+    total_us = 0
+    imported = set()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        if not cumulative_us.strip().isdigit():
+            continue
+        imported.add(name.strip())
+        # Only top level alive imports are counted, as nested imports are
+        # included in their parent's cumulative time, and other top level
+        # imports are part of interpreter startup
+        name = name[1:]
+        if name == 'alive' or name.startswith('alive.'):
+            total_us += int(cumulative_us)
+    return total_us / 1000.0, imported
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('-b', '--budget', type=float, default=DEFAULT_BUDGET_MS,
+                    help='Import time budget in ms (default: %(default)s)')
+    ap.add_argument('-n', '--runs', type=int, default=DEFAULT_RUNS,
+                    help=('Number of runs, of which the fastest is used '
+                          '(default: %(default)s)'))
+    args = ap.parse_args()
+    failed = False
+    for entry_point, modules in sorted(ENTRY_POINTS.items()):
+        results = [measure(modules) for run in range(args.runs)]
+        best_ms = min(total_ms for total_ms, imported in results)
+        eager = sorted(module for module in LAZY_MODULES
+                       if module in results[0][1])
+        status = 'OK'
+        if best_ms > args.budget or eager:
+            status = 'FAIL'
+            failed = True
+        print('{}: {:.1f} ms (budget {:.1f} ms) {}'
+              .format(entry_point, best_ms, args.budget, status))
+        if eager:
+            print('  Imported at startup: {}'.format(', '.join(eager)))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,773 @@
+#!/usr/bin/env python3
+"""
+End-to-end load harness, which runs alive-check against a local fake Twitter
+API serving generated or recorded tweets at a configurable rate and error
+profile, with a fake sendmail, SMTP or LMTP server recording each delivered
+message. Reports throughput, trigger to delivery latency percentiles, and any
+missed, duplicated or corrupted sends.
+"""
+from __future__ import print_function
+
+import argparse
+import calendar
+import email
+import http.server
+import json
+import os
+import platform
+import random
+import re
+import signal
+import socketserver
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from alive.rules import RuleSet  # noqa: E402
+from micro import Fixtures  # noqa: E402
+from micro import SkipBenchmark  # noqa: E402
+from micro import TWEET_TIME_FORMAT  # noqa: E402
+
+DEFAULT_DURATION = 60
+DEFAULT_INTERVAL = 5
+DEFAULT_DRAIN_TIMEOUT = 60
+DEFAULT_USERS = 10
+DEFAULT_RATE = 5
+DEFAULT_TRIGGER_EVERY = 20
+KEYWORD = 'alive'
+FIRST_TWEET_ID = 1000
+RATE_LIMIT_REMAINING = 900
+RATE_LIMIT_WINDOW = 900
+# Simulated rate limiting lasts until the next second, so the checks which
+# hit it are deferred rather than the whole run
+RATE_LIMITED_WINDOW = 1
+# Exit status of the fake sendmail for simulated failures (EX_TEMPFAIL)
+SENDMAIL_TEMPFAIL = 75
+SMTP_TEMPFAIL = 451
+SMTP_READ_SIZE = 4096
+# Lines of the outgoing message, which include lines starting with dots so
+# that dot-stuffing is checked
+MESSAGE_LINES = [
+    'Load test message text.',
+    '.',
+    '.. with leading dots',
+    '...',
+]
+PERCENTILES = [50, 90, 99]
+LOG_TAIL_LINES = 20
+
+CONFIG = '''\
+email:
+  from: Sender <sender@example.com>
+  to: recipient@example.com
+  subject: Load test
+  message: |
+{message}
+  transport:
+{transport}
+twitter:
+  username: [{usernames}]
+  keyword: {keyword}
+  consumer_key: key
+  consumer_secret: secret
+  access_token_key: token
+  access_token_secret: token_secret
+  api_url: http://127.0.0.1:{port}
+{twitter_options}daemon:
+  jitter: 0
+  intervals:
+    twitter: {interval}
+outbox:
+  retry_interval: 1
+  max_retry_interval: 5
+'''
+
+SENDMAIL = '''\
+#!{python}
+import os
+import random
+import sys
+import time
+
+time.sleep({delay!r})
+data = sys.stdin.buffer.read()
+if random.random() < {error_rate!r}:
+    sys.exit({tempfail})
+name = os.path.join({sink_dir!r}, '{{:.6f}}-{{}}'.format(time.time(),
+                                                       os.getpid()))
+with open(name + '.tmp', 'wb') as f:
+    f.write(data)
+os.rename(name + '.tmp', name + '.eml')
+'''
+
+
+class TweetStream(object):
+    def __init__(self, usernames):
+        self.usernames = usernames
+        self.rules = RuleSet.from_keywords([KEYWORD])
+        self.published = {}
+        self.triggers = set()
+        self._timelines = {username.lower(): [] for username in usernames}
+        self._next_id = FIRST_TWEET_ID
+        self._lock = threading.Lock()
+
+    def publish(self, username, text):
+        with self._lock:
+            tweet_id = self._next_id
+            self._next_id += 1
+            now = time.time()
+            self._timelines[username.lower()].append({
+                'id': tweet_id,
+                'id_str': str(tweet_id),
+                'created_at': time.strftime(TWEET_TIME_FORMAT,
+                                            time.gmtime(now)),
+                'full_text': text,
+                'user': {'screen_name': username},
+            })
+            self.published[tweet_id] = now
+            rule = self.rules.match(text)
+            if rule and rule.action != 'ignore':
+                self.triggers.add(tweet_id)
+
+    def timeline(self, screen_name, count, since_id=None, max_id=None):
+        # Returns the most recent tweets first, as the Twitter API does
+        with self._lock:
+            tweets = self._timelines.get(screen_name.lower(), [])
+            return [tweet for tweet in reversed(tweets)
+                    if (since_id is None or tweet['id'] > since_id) and
+                    (max_id is None or tweet['id'] <= max_id)][:count]
+
+
+def generate(stream, args, stop):
+    # Tweets are published round robin across the users at a steady rate,
+    # with a burst of triggers halfway through when requested
+    start = time.time()
+    burst_at = start + args.duration / 2.0 if args.burst else None
+    i = 0
+    while not stop.wait(max(start + i / args.rate - time.time(), 0)):
+        if time.time() >= start + args.duration:
+            return
+        username = stream.usernames[i % len(stream.usernames)]
+        text = 'Load test tweet number {}'.format(i)
+        if i % args.trigger_every == 0:
+            text = '{} {}'.format(KEYWORD, text)
+        stream.publish(username, text)
+        if burst_at is not None and time.time() >= burst_at:
+            burst_at = None
+            for b in range(args.burst):
+                stream.publish(stream.usernames[b % len(stream.usernames)],
+                               '{} Burst tweet number {}'.format(KEYWORD, b))
+        i += 1
+
+
+def replay(stream, tweets, args, stop):
+    # Recorded tweets are republished with their original spacing, scaled by
+    # the replay speed
+    first = tweets[0]['created_at_in_seconds']
+    start = time.time()
+    for tweet in tweets:
+        offset = (tweet['created_at_in_seconds'] - first) / args.speed
+        if stop.wait(max(start + offset - time.time(), 0)):
+            return
+        stream.publish(tweet['user']['screen_name'],
+                       tweet.get('full_text', tweet.get('text', '')))
+
+
+def load_recording(file_name):
+    # Recordings are lists of tweets as returned by the Twitter API, or
+    # mappings of usernames to such lists
+    with open(file_name, 'r') as f:
+        recording = json.load(f)
+    if isinstance(recording, dict):
+        recording = [tweet for timeline in recording.values()
+                     for tweet in timeline]
+    for tweet in recording:
+        tweet['created_at_in_seconds'] = calendar.timegm(time.strptime(
+            tweet['created_at'], TWEET_TIME_FORMAT))
+    if not recording:
+        raise Exception('{} contains no tweets'.format(file_name))
+    return sorted(recording, key=lambda tweet: tweet['created_at_in_seconds'])
+
+
+class FakeTwitterServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, stream, timeline_path, args):
+        http.server.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                        FakeTwitterHandler)
+        self.stream = stream
+        self.timeline_path = timeline_path
+        self.args = args
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def count(self, error=False):
+        with self._lock:
+            self.requests += 1
+            if error:
+                self.errors += 1
+
+
+class FakeTwitterHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        if url.path != server.timeline_path:
+            self._respond(404, {'errors': [{'message': 'Not found'}]})
+            return
+        time.sleep(server.args.api_latency)
+        failure = random.random()
+        if failure < server.args.api_error_rate:
+            server.count(error=True)
+            self._respond(503, {'errors': [{'message': 'Over capacity'}]})
+            return
+        if failure < server.args.api_error_rate + server.args.rate_limit_rate:
+            server.count(error=True)
+            self._respond(429, {'errors': [{'message': 'Rate limited'}]},
+                          remaining=0, window=RATE_LIMITED_WINDOW)
+            return
+        params = {name: values[-1]
+                  for name, values in parse_qs(url.query).items()}
+        server.count()
+        self._respond(200, server.stream.timeline(
+            params.get('screen_name', ''), int(params.get('count', 20)),
+            int(params['since_id']) if 'since_id' in params else None,
+            int(params['max_id']) if 'max_id' in params else None))
+
+    def _respond(self, status, body, remaining=RATE_LIMIT_REMAINING,
+                 window=RATE_LIMIT_WINDOW):
+        content = json.dumps(body).encode('UTF-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('x-rate-limit-remaining', str(remaining))
+        self.send_header('x-rate-limit-reset',
+                         str(int(time.time()) + window))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeSMTPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    # Records each message delivered over SMTP or LMTP in the sink directory,
+    # checking that the client only pipelines commands when PIPELINING is
+    # advertised
+    daemon_threads = True
+
+    def __init__(self, sink_dir, args):
+        socketserver.TCPServer.__init__(self, ('127.0.0.1', 0),
+                                        FakeSMTPHandler)
+        self.sink_dir = sink_dir
+        self.args = args
+        self.connections = 0
+        self.pipelined = 0
+        self.protocol_errors = []
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def protocol_error(self, error):
+        with self._lock:
+            self.protocol_errors.append(error)
+
+
+class FakeSMTPHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self._buffer = b''
+        self._replies = []
+        try:
+            self._session()
+        finally:
+            self._flush()
+
+    def _session(self):
+        server = self.server
+        server.count('connections')
+        greeting = 'LHLO' if server.args.transport == 'lmtp' else 'EHLO'
+        sender = None
+        recipients = []
+        self._reply(220, '127.0.0.1 Fake {}'.format(
+            server.args.transport.upper()))
+        while True:
+            line = self._readline()
+            if line is None:
+                return
+            if b'\r\n' in self._buffer:
+                # The next command was sent without waiting for this reply
+                if server.args.no_pipelining:
+                    server.protocol_error('Pipelined without PIPELINING')
+                server.count('pipelined')
+            command = line.decode('ascii', 'replace')
+            verb = command.split(' ', 1)[0].upper()
+            if verb in ('EHLO', 'LHLO', 'HELO'):
+                if verb != greeting:
+                    server.protocol_error('Unexpected {}'.format(verb))
+                    self._reply(500, 'Use {}'.format(greeting))
+                    continue
+                self._reply(250, '127.0.0.1', *(
+                    [] if server.args.no_pipelining else ['PIPELINING']) +
+                    ['8BITMIME'])
+            elif verb == 'MAIL':
+                sender = command
+                recipients = []
+                self._reply(250, 'OK')
+            elif verb == 'RCPT':
+                if sender is None:
+                    server.protocol_error('RCPT before MAIL')
+                recipients.append(command)
+                self._reply(250, 'OK')
+            elif verb == 'DATA':
+                if not recipients:
+                    server.protocol_error('DATA without recipients')
+                    self._reply(503, 'No recipients')
+                    continue
+                self._reply(354, 'Send data')
+                data = self._read_data()
+                if data is None:
+                    return
+                self._deliver(data, recipients)
+                sender = None
+                recipients = []
+            elif verb == 'RSET':
+                sender = None
+                recipients = []
+                self._reply(250, 'OK')
+            elif verb == 'NOOP':
+                self._reply(250, 'OK')
+            elif verb == 'QUIT':
+                self._reply(221, 'Bye')
+                return
+            else:
+                server.protocol_error('Unknown command {}'.format(verb))
+                self._reply(500, 'Unknown command')
+
+    def _deliver(self, data, recipients):
+        time.sleep(self.server.args.sendmail_delay)
+        # LMTP replies for each recipient
+        replies = (len(recipients) if self.server.args.transport == 'lmtp'
+                   else 1)
+        if random.random() < self.server.args.sendmail_error_rate:
+            for i in range(replies):
+                self._reply(SMTP_TEMPFAIL, 'Try again later')
+            return
+        write_sink(self.server.sink_dir, data)
+        for i in range(replies):
+            self._reply(250, 'Delivered')
+
+    def _read_data(self):
+        # Reads the message up to the line containing only a dot, removing
+        # the dot added to each line starting with a dot
+        lines = []
+        while True:
+            line = self._readline()
+            if line is None:
+                return None
+            if line == b'.':
+                return b''.join(lines)
+            if line.startswith(b'.'):
+                line = line[1:]
+            lines.append(line + b'\r\n')
+
+    def _readline(self):
+        while b'\r\n' not in self._buffer:
+            # Replies to pipelined commands are sent together, as servers
+            # supporting PIPELINING do
+            self._flush()
+            data = self.request.recv(SMTP_READ_SIZE)
+            if not data:
+                return None
+            self._buffer += data
+        line, self._buffer = self._buffer.split(b'\r\n', 1)
+        return line
+
+    def _reply(self, code, *lines):
+        self._replies += [
+            '{}{}{}\r\n'.format(code, ' ' if i == len(lines) - 1 else '-',
+                                line).encode('ascii')
+            for i, line in enumerate(lines)]
+
+    def _flush(self):
+        if self._replies:
+            self.request.sendall(b''.join(self._replies))
+            self._replies = []
+
+
+def write_sink(sink_dir, data):
+    # Messages are named by their receipt time
+    name = os.path.join(sink_dir, '{:.6f}-{}'.format(time.time(),
+                                                     uuid.uuid4().hex))
+    with open(name + '.tmp', 'wb') as f:
+        f.write(data)
+    os.rename(name + '.tmp', name + '.eml')
+
+
+def start_delivery(fixtures, args):
+    # Returns the transport configuration, and the fake SMTP or LMTP server
+    # if there is one
+    sink_dir = os.path.join(fixtures.dir, 'sink')
+    os.makedirs(sink_dir)
+    if args.transport == 'sendmail':
+        sendmail = write_sendmail(fixtures, args, sink_dir)
+        return ('    type: sendmail\n'
+                '    path: {}\n'.format(sendmail), None, sink_dir)
+    server = FakeSMTPServer(sink_dir, args)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return ('    type: {}\n'
+            '    host: 127.0.0.1\n'
+            '    port: {}\n'.format(args.transport, server.server_address[1]),
+            server, sink_dir)
+
+
+def write_sendmail(fixtures, args, sink_dir):
+    sendmail = os.path.join(fixtures.dir, 'sendmail')
+    with open(sendmail, 'w') as f:
+        f.write(SENDMAIL.format(python=sys.executable,
+                                delay=args.sendmail_delay,
+                                error_rate=args.sendmail_error_rate,
+                                tempfail=SENDMAIL_TEMPFAIL,
+                                sink_dir=sink_dir))
+    os.chmod(sendmail, 0o755)
+    return sendmail
+
+
+def write_config(fixtures, stream, server, transport, args):
+    config_dir = os.path.join(fixtures.dir, 'load')
+    os.makedirs(config_dir, 0o0700)
+    with open(os.path.join(config_dir, 'config.yaml'), 'w') as f:
+        f.write(CONFIG.format(message='\n'.join(
+                                  '    {}'.format(line)
+                                  for line in MESSAGE_LINES),
+                              transport=transport.rstrip('\n'),
+                              usernames=', '.join(stream.usernames),
+                              keyword=KEYWORD,
+                              port=server.server_address[1],
+                              twitter_options=''.join(
+                                  '  {}: {}\n'.format(name, value)
+                                  for name, value in [
+                                      ('page_size', args.page_size),
+                                      ('max_backfill', args.max_backfill)]
+                                  if value is not None),
+                              interval=args.interval))
+    return config_dir
+
+
+def home_dir(fixtures, args):
+    # alive signs messages using the GnuPG home directory in $HOME
+    home = os.path.join(fixtures.dir, 'home')
+    os.makedirs(home)
+    os.symlink(os.path.abspath(args.gnupg_dir) if args.gnupg_dir
+               else fixtures.gnupg_dir(), os.path.join(home, '.gnupg'))
+    return home
+
+
+def received(sink_dir, tweet_id_re):
+    # Returns (receipt time, tweet IDs, whether the message text is intact)
+    # for each message delivered so far
+    message_text = '\n'.join(MESSAGE_LINES)
+    messages = []
+    for name in sorted(os.listdir(sink_dir)):
+        if not name.endswith('.eml'):
+            continue
+        with open(os.path.join(sink_dir, name), 'rb') as f:
+            message = email.message_from_binary_file(f)
+        tweet_ids = []
+        intact = False
+        for part in message.walk():
+            if (part.get_content_type() == 'text/plain' and
+                    not part.get_filename()):
+                text = part.get_payload(decode=True).decode('UTF-8',
+                                                            'replace')
+                tweet_ids += [int(tweet_id)
+                              for tweet_id in tweet_id_re.findall(text)]
+                intact = intact or message_text in '\n'.join(
+                    text.splitlines())
+        messages.append((float(name.split('-', 1)[0]), tweet_ids, intact))
+    return messages
+
+
+def deliveries(messages):
+    # Returns the receipt times of the messages including each tweet
+    receipt_times = {}
+    for receipt_time, tweet_ids, intact in messages:
+        for tweet_id in set(tweet_ids):
+            receipt_times.setdefault(tweet_id, []).append(receipt_time)
+    return receipt_times
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(int(len(values) * percent / 100.0), len(values) - 1)]
+
+
+class Runner(object):
+    def __init__(self, config_dir, home, args):
+        self.args = args
+        self.command = [sys.executable, '-c',
+                        'from alive.main import check; check()',
+                        '--config-dir', config_dir]
+        python_path = [REPO_DIR]
+        if os.environ.get('PYTHONPATH'):
+            python_path.append(os.environ['PYTHONPATH'])
+        self.env = dict(os.environ, HOME=home,
+                        PYTHONPATH=os.pathsep.join(python_path))
+        self.log = open(os.path.join(config_dir, 'alive-check.log'), 'w')
+        self.runs = 0
+        self.failed_runs = 0
+        self.run_times = []
+        self._daemon = None
+
+    def start(self):
+        if self.args.daemon:
+            self._daemon = subprocess.Popen(
+                self.command + ['--daemon', 'twitter'], env=self.env,
+                stdout=self.log, stderr=subprocess.STDOUT)
+
+    def tick(self):
+        # Runs alive-check once, unless the daemon is checking on its own
+        if self._daemon:
+            if self._daemon.poll() is not None:
+                raise Exception('alive-check --daemon exited with status {}'
+                                .format(self._daemon.returncode))
+            time.sleep(self.args.interval)
+            return
+        start = time.time()
+        status = subprocess.call(self.command + ['twitter'], env=self.env,
+                                 stdout=self.log, stderr=subprocess.STDOUT)
+        self.runs += 1
+        self.run_times.append(time.time() - start)
+        if status:
+            self.failed_runs += 1
+        time.sleep(max(start + self.args.interval - time.time(), 0))
+
+    def stop(self):
+        if self._daemon:
+            self._daemon.send_signal(signal.SIGTERM)
+            self._daemon.wait()
+        self.log.close()
+
+
+def run_load(fixtures, args):
+    try:
+        from alive.sources.twitter import TWEET_URL_FORMAT
+        from alive.sources.twitter_api import USER_TIMELINE_PATH
+    except ImportError as e:
+        raise SkipBenchmark(str(e))
+    tweet_id_re = re.compile(re.escape(TWEET_URL_FORMAT.format('')) +
+                             r'(\d+)')
+    if args.replay:
+        recording = load_recording(args.replay)
+        usernames = sorted({tweet['user']['screen_name']
+                            for tweet in recording})
+    else:
+        usernames = ['user{}'.format(i) for i in range(args.users)]
+    stream = TweetStream(usernames)
+    server = FakeTwitterServer(stream, USER_TIMELINE_PATH, args)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    transport, smtp_server, sink_dir = start_delivery(fixtures, args)
+    config_dir = write_config(fixtures, stream, server, transport, args)
+    runner = Runner(config_dir, home_dir(fixtures, args), args)
+    stop = threading.Event()
+    if args.replay:
+        publisher = threading.Thread(target=replay,
+                                     args=(stream, recording, args, stop))
+    else:
+        publisher = threading.Thread(target=generate,
+                                     args=(stream, args, stop))
+    print('Running alive-check against {} user(s) for {} s (log: {})'
+          .format(len(usernames), args.duration, runner.log.name))
+    start = time.time()
+    runner.start()
+    publisher.start()
+    try:
+        while publisher.is_alive():
+            runner.tick()
+        # Keep checking until every trigger has been delivered, or until the
+        # drain timeout expires
+        drain_deadline = time.time() + args.drain_timeout
+        while (time.time() < drain_deadline and
+               not stream.triggers <= set(deliveries(
+                   received(sink_dir, tweet_id_re)))):
+            runner.tick()
+    finally:
+        stop.set()
+        publisher.join()
+        runner.stop()
+        server.shutdown()
+        server.server_close()
+        if smtp_server:
+            smtp_server.shutdown()
+            smtp_server.server_close()
+    elapsed = time.time() - start
+    return report(stream, server, smtp_server, runner,
+                  received(sink_dir, tweet_id_re), elapsed)
+
+
+def report(stream, server, smtp_server, runner, messages, elapsed):
+    receipt_times = deliveries(messages)
+    latencies = [min(times) - stream.published[tweet_id]
+                 for tweet_id, times in receipt_times.items()
+                 if tweet_id in stream.published]
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'created': time.time(),
+        'elapsed': elapsed,
+        'tweets': len(stream.published),
+        'triggers': len(stream.triggers),
+        'api_requests': server.requests,
+        'api_errors': server.errors,
+        'runs': runner.runs,
+        'failed_runs': runner.failed_runs,
+        'messages': len(messages),
+        'delivered': len(stream.triggers & set(receipt_times)),
+        'missed': sorted(stream.triggers - set(receipt_times)),
+        'duplicated': sorted(tweet_id for tweet_id, times
+                             in receipt_times.items() if len(times) > 1),
+        'unexpected': sorted(set(receipt_times) - stream.triggers),
+        'corrupted': len([message for message in messages
+                          if not message[2]]),
+        'throughput': len(messages) / elapsed,
+        'latency': {},
+    }
+    if smtp_server:
+        results.update({
+            'smtp_connections': smtp_server.connections,
+            'smtp_pipelined': smtp_server.pipelined,
+            'smtp_protocol_errors': smtp_server.protocol_errors,
+        })
+    if latencies:
+        results['latency'] = dict(
+            [('p{}'.format(percent), percentile(latencies, percent))
+             for percent in PERCENTILES] +
+            [('max', max(latencies)), ('mean', statistics.mean(latencies))])
+    print('Published {} tweet(s) with {} trigger(s) in {:.1f} s'
+          .format(results['tweets'], results['triggers'], elapsed))
+    print('API requests: {} ({} failed)'
+          .format(results['api_requests'], results['api_errors']))
+    if runner.runs:
+        print('alive-check runs: {} ({} failed), median {:.2f} s'
+              .format(runner.runs, runner.failed_runs,
+                      statistics.median(runner.run_times)))
+    print('Messages received: {} ({:.2f} per second)'
+          .format(results['messages'], results['throughput']))
+    print('Triggers delivered: {}, missed: {}, duplicated: {}, '
+          'unexpected: {}'.format(results['delivered'],
+                                  len(results['missed']),
+                                  len(results['duplicated']),
+                                  len(results['unexpected'])))
+    print('Corrupted messages: {}'.format(results['corrupted']))
+    if smtp_server:
+        print('{} connections: {}, pipelined commands: {}, protocol errors: '
+              '{}'.format(smtp_server.args.transport.upper(),
+                          smtp_server.connections, smtp_server.pipelined,
+                          len(smtp_server.protocol_errors)))
+        for error in sorted(set(smtp_server.protocol_errors)):
+            print('  {}'.format(error))
+    if runner.failed_runs or results['missed']:
+        # The log is removed with the fixtures, so show how the last runs
+        # failed
+        with open(runner.log.name, 'r') as f:
+            print('Last alive-check output:')
+            print(''.join(f.readlines()[-LOG_TAIL_LINES:]), end='')
+    if latencies:
+        print('Trigger to delivery latency: {}'.format(', '.join(
+            '{} {:.2f} s'.format(name, results['latency'][name])
+            for name in ['p{}'.format(percent) for percent in PERCENTILES] +
+            ['max'])))
+    return results
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('-d', '--duration', type=float, default=DEFAULT_DURATION,
+                    help=('Seconds to publish tweets for '
+                          '(default: %(default)s)'))
+    ap.add_argument('-i', '--interval', type=float, default=DEFAULT_INTERVAL,
+                    help=('Seconds between checks (default: %(default)s)'))
+    ap.add_argument('--daemon', action='store_true',
+                    help='Run alive-check --daemon rather than periodic runs')
+    ap.add_argument('--drain-timeout', type=float,
+                    default=DEFAULT_DRAIN_TIMEOUT,
+                    help=('Seconds to keep checking for undelivered triggers '
+                          'after publishing stops (default: %(default)s)'))
+    ap.add_argument('-u', '--users', type=int, default=DEFAULT_USERS,
+                    help='Number of generated users (default: %(default)s)')
+    ap.add_argument('-r', '--rate', type=float, default=DEFAULT_RATE,
+                    help=('Generated tweets per second across all users '
+                          '(default: %(default)s)'))
+    ap.add_argument('--trigger-every', type=int,
+                    default=DEFAULT_TRIGGER_EVERY,
+                    help=('One in this many generated tweets is a trigger '
+                          '(default: %(default)s)'))
+    ap.add_argument('--burst', type=int, default=0,
+                    help=('Number of triggers published at once halfway '
+                          'through (default: %(default)s)'))
+    ap.add_argument('--replay', metavar='file',
+                    help=('Replay recorded tweets from a JSON file instead '
+                          'of generating them'))
+    ap.add_argument('--speed', type=float, default=1.0,
+                    help='Replay speed multiplier (default: %(default)s)')
+    ap.add_argument('--page-size', type=int,
+                    help='Tweets requested per page (twitter.page_size)')
+    ap.add_argument('--max-backfill', type=int,
+                    help=('Maximum tweets fetched per user in each check '
+                          '(twitter.max_backfill)'))
+    ap.add_argument('--api-latency', type=float, default=0.0,
+                    help=('Seconds of delay per API request '
+                          '(default: %(default)s)'))
+    ap.add_argument('--api-error-rate', type=float, default=0.0,
+                    help=('Fraction of API requests failing with status 503 '
+                          '(default: %(default)s)'))
+    ap.add_argument('--rate-limit-rate', type=float, default=0.0,
+                    help=('Fraction of API requests failing with status 429 '
+                          '(default: %(default)s)'))
+    ap.add_argument('--transport', choices=['sendmail', 'smtp', 'lmtp'],
+                    default='sendmail',
+                    help=('Deliver to a fake sendmail, or to a fake SMTP or '
+                          'LMTP server (default: %(default)s)'))
+    ap.add_argument('--no-pipelining', action='store_true',
+                    help=('Do not advertise PIPELINING from the fake SMTP or '
+                          'LMTP server'))
+    ap.add_argument('--sendmail-delay', type=float, default=0.0,
+                    help=('Seconds of delay per delivered message '
+                          '(default: %(default)s)'))
+    ap.add_argument('--sendmail-error-rate', type=float, default=0.0,
+                    help=('Fraction of deliveries failing temporarily '
+                          '(default: %(default)s)'))
+    ap.add_argument('--gnupg-dir', metavar='dir',
+                    help=('GnuPG home directory with a signing key for '
+                          'sender@example.com (default: a throwaway key)'))
+    ap.add_argument('-o', '--output', metavar='file',
+                    help='Write the results to a JSON file')
+    args = ap.parse_args()
+    fixtures = Fixtures()
+    try:
+        results = run_load(fixtures, args)
+    except SkipBenchmark as e:
+        print('Skipped: {}'.format(e))
+        return 0
+    finally:
+        fixtures.close()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 1 if (results['missed'] or results['duplicated'] or
+                 results['corrupted'] or
+                 results.get('smtp_protocol_errors')) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
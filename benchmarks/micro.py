@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks of the hot paths of alive (message construction and
+serialization, signing, tweet filtering and configuration loading) using
+synthetic fixtures. Results are written as JSON, and can be compared against
+a baseline to flag regressions in time or peak memory.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+# Results depend on the machine, so each machine keeps its own baseline,
+# which is not committed
+DEFAULT_BASELINE = os.path.join(REPO_DIR, 'benchmarks', 'baseline.json')
+
+from alive.config import Config  # noqa: E402
+from alive.email_message import EmailMessage  # noqa: E402
+from alive.state import StateStore  # noqa: E402
+
+DEFAULT_RUNS = 5
+DEFAULT_TIME_THRESHOLD = 0.2
+DEFAULT_MEMORY_THRESHOLD = 0.1
+MANY_ATTACHMENTS = 100
+MANY_ATTACHMENTS_SIZE = 16 * 1024
+LARGE_ATTACHMENT_SIZE = 32 * 1024 * 1024
+TIMELINE_USERS = 10
+TIMELINE_TWEETS = 2000
+# One in TRIGGER_EVERY synthetic tweets starts with the trigger keyword
+TRIGGER_EVERY = 100
+TWEET_TIME_FORMAT = '%a %b %d %H:%M:%S +0000 %Y'
+
+CONFIG = '''\
+email:
+  from: Sender <sender@example.com>
+  to:
+    - recipient1@example.com
+    - recipient2@example.com
+  cc: cc@example.com
+  subject: Benchmark
+  message: |
+    {message}
+  attachments:
+    - {attachments}
+twitter:
+  username: [{usernames}]
+  keyword: alive
+  consumer_key: key
+  consumer_secret: secret
+  access_token_key: token
+  access_token_secret: token_secret
+  max_backfill: {max_backfill}
+daemon:
+  interval: 300
+  intervals:
+    twitter: 60
+outbox:
+  retry_interval: 60
+'''
+
+
+class SkipBenchmark(Exception):
+    pass
+
+
+class Fixtures(object):
+    def __init__(self):
+        self.dir = tempfile.mkdtemp(prefix='alive-benchmarks-')
+        self._gnupg_dir = None
+
+    def attachments(self, name, count, size):
+        attachment_dir = os.path.join(self.dir, name)
+        if not os.path.isdir(attachment_dir):
+            os.makedirs(attachment_dir)
+            for i in range(count):
+                with open(os.path.join(attachment_dir,
+                                       'attachment{}.bin'.format(i)),
+                          'wb') as f:
+                    f.write(os.urandom(size))
+        return attachment_dir
+
+    def config_dir(self):
+        config_dir = os.path.join(self.dir, 'config')
+        if not os.path.isdir(config_dir):
+            os.makedirs(config_dir, 0o0700)
+            with open(os.path.join(config_dir, 'config.yaml'), 'w') as f:
+                f.write(CONFIG.format(
+                    message='Benchmark message text. ' * 50,
+                    attachments=self.attachments('config_attachments', 1, 1),
+                    usernames=', '.join(self.usernames()),
+                    max_backfill=2 * TIMELINE_TWEETS))
+        return config_dir
+
+    def usernames(self):
+        return ['user{}'.format(i) for i in range(TIMELINE_USERS)]
+
+    def timelines(self):
+        # Timelines are latest first, with the users' tweets interleaved
+        now = int(time.time())
+        timelines = {}
+        for u, username in enumerate(self.usernames()):
+            timeline = []
+            for i in range(TIMELINE_TWEETS):
+                tweet_id = (TIMELINE_TWEETS - i) * TIMELINE_USERS + u
+                text = 'Synthetic tweet number {} from {}'.format(i, username)
+                if i % TRIGGER_EVERY == 0:
+                    text = 'alive {}'.format(text)
+                timeline.append({
+                    'id': tweet_id,
+                    'id_str': str(tweet_id),
+                    'created_at': time.strftime(
+                        TWEET_TIME_FORMAT, time.gmtime(now - i)),
+                    'full_text': text,
+                    'user': {'screen_name': username},
+                })
+            timelines[username] = timeline
+        return timelines
+
+    def gnupg_dir(self):
+        if not self._gnupg_dir:
+            try:
+                import gnupg
+            except ImportError:
+                raise SkipBenchmark('gnupg is not installed')
+            gnupg_dir = os.path.join(self.dir, 'gnupg')
+            os.makedirs(gnupg_dir, 0o0700)
+            gpg = gnupg.GPG(gnupghome=gnupg_dir)
+            key = gpg.gen_key(gpg.gen_key_input(
+                key_type='RSA', key_length=2048, name_real='alive benchmark',
+                name_email='sender@example.com', no_protection=True))
+            if not key:
+                raise SkipBenchmark('Unable to generate a signing key: {}'
+                                    .format(key.stderr))
+            self._gnupg_dir = gnupg_dir
+        return self._gnupg_dir
+
+    def close(self):
+        if self._gnupg_dir:
+            # Stop the gpg-agent started for the throwaway home directory
+            subprocess.call(['gpgconf', '--homedir', self._gnupg_dir,
+                             '--kill', 'gpg-agent'])
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+class FakeTimelineClient(object):
+    def __init__(self, timelines):
+        self.timelines = timelines
+        self.received_bytes = 0
+
+    def user_timeline(self, screen_name, count, since_id=None, max_id=None):
+        return [tweet for tweet in self.timelines[screen_name]
+                if (since_id is None or tweet['id'] > since_id) and
+                (max_id is None or tweet['id'] <= max_id)][:count]
+
+    def user_timelines(self, requests, page_size, max_tweets):
+        from alive.sources.twitter_api import TimelinePages
+        return [TimelinePages(self, *request, page_size=page_size,
+                              max_tweets=max_tweets)
+                for request in requests]
+
+
+def _email(attachments, **kwargs):
+    return EmailMessage(sender='Sender <sender@example.com>',
+                        to=['recipient@example.com'],
+                        subject='Benchmark',
+                        message='Benchmark message text. ' * 50,
+                        attachments=attachments,
+                        flowed=True,
+                        **kwargs)
+
+
+def email_many_attachments(fixtures):
+    attachments = [fixtures.attachments('many', MANY_ATTACHMENTS,
+                                        MANY_ATTACHMENTS_SIZE)]
+    return lambda: None, lambda setup: str(_email(attachments))
+
+
+def email_large_attachment(fixtures):
+    attachments = [fixtures.attachments('large', 1, LARGE_ATTACHMENT_SIZE)]
+    return lambda: None, lambda setup: str(_email(attachments))
+
+
+def sign_message(fixtures):
+    from alive.signing import Signer
+    signer = Signer(gnupg_dir=fixtures.gnupg_dir())
+    attachments = [fixtures.attachments('many', MANY_ATTACHMENTS,
+                                        MANY_ATTACHMENTS_SIZE)]
+    # The signer, and with it the GnuPG session, is shared by every run
+    return (lambda: _email(attachments, sign=True, signer=signer),
+            lambda email: email._sign_message())
+
+
+def twitter_check(fixtures):
+    try:
+        from alive.sources.twitter import Twitter
+    except ImportError as e:
+        raise SkipBenchmark(str(e))
+    config = Config(fixtures.config_dir())
+    timelines = fixtures.timelines()
+
+    def setup():
+        state_dir = tempfile.mkdtemp(dir=fixtures.dir)
+        source = Twitter(config, StateStore(state_dir))
+        source._twitter = FakeTimelineClient(timelines)
+        # With a cursor before the first tweet, every page is fetched
+        for username in timelines:
+            source.state.set(source.name, 'cursor:{}'.format(username),
+                             {'since_id': -1})
+        return source
+
+    def run(source):
+        for source_text, is_test, profile, processed in source.check():
+            processed()
+        source.state.close()
+
+    return setup, run
+
+
+def config_load(fixtures):
+    config_dir = fixtures.config_dir()
+    return lambda: None, lambda setup: Config(config_dir, use_cache=False)
+
+
+def config_load_cached(fixtures):
+    config_dir = fixtures.config_dir()
+    Config(config_dir)
+    return lambda: None, lambda setup: Config(config_dir)
+
+
+BENCHMARKS = {
+    'email_many_attachments': email_many_attachments,
+    'email_large_attachment': email_large_attachment,
+    'sign_message': sign_message,
+    'twitter_check': twitter_check,
+    'config_load': config_load,
+    'config_load_cached': config_load_cached,
+}
+
+
+def measure(benchmark, fixtures, runs):
+    setup, run = benchmark(fixtures)
+    times = []
+    for i in range(runs):
+        args = setup()
+        start = time.perf_counter()
+        run(args)
+        times.append(time.perf_counter() - start)
+    # Peak memory is measured in a separate run, as tracing allocations
+    # slows down the code being measured
+    args = setup()
+    tracemalloc.start()
+    try:
+        run(args)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'runs': runs,
+        'min': min(times),
+        'median': statistics.median(times),
+        'peak_memory': peak,
+    }
+
+
+def run_benchmarks(args):
+    names = args.benchmark
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'created': time.time(),
+        'benchmarks': {},
+    }
+    fixtures = Fixtures()
+    try:
+        for name in names:
+            try:
+                result = measure(BENCHMARKS[name], fixtures, args.runs)
+            except SkipBenchmark as e:
+                print('{}: skipped ({})'.format(name, e))
+                continue
+            results['benchmarks'][name] = result
+            print('{}: {:.2f} ms (min {:.2f} ms), peak memory {:.1f} KiB'
+                  .format(name, result['median'] * 1000,
+                          result['min'] * 1000,
+                          result['peak_memory'] / 1024.0))
+    finally:
+        fixtures.close()
+    return results
+
+
+def compare(baseline, results, time_threshold, memory_threshold):
+    regressions = []
+    for name, result in sorted(results['benchmarks'].items()):
+        base = baseline['benchmarks'].get(name)
+        if not base:
+            print('{}: no baseline'.format(name))
+            continue
+        # The fastest run is compared, as it is the least affected by noise
+        time_change = result['min'] / base['min'] - 1
+        memory_change = (result['peak_memory'] /
+                         float(max(base['peak_memory'], 1)) - 1)
+        status = 'OK'
+        if time_change > time_threshold or memory_change > memory_threshold:
+            status = 'REGRESSION'
+            regressions.append(name)
+        print('{}: time {:+.1%}, peak memory {:+.1%} {}'
+              .format(name, time_change, memory_change, status))
+    return regressions
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    subparsers = ap.add_subparsers(dest='command')
+    subparsers.required = True
+    run_ap = subparsers.add_parser('run', help='Run the benchmarks')
+    all_benchmarks_choice = 'all'
+    run_ap.add_argument('benchmark', metavar='benchmark', nargs='*',
+                        default=all_benchmarks_choice,
+                        choices=[all_benchmarks_choice] + sorted(BENCHMARKS),
+                        help=('Benchmark(s) to run (default: %(default)s, '
+                              'choices: %(choices)s)'))
+    run_ap.add_argument('-n', '--runs', type=int, default=DEFAULT_RUNS,
+                        help='Number of timed runs (default: %(default)s)')
+    run_ap.add_argument('-o', '--output', metavar='file',
+                        help=('Write the results to a JSON file, such as '
+                              '{} to use them as the baseline'
+                              .format(os.path.relpath(DEFAULT_BASELINE))))
+    compare_ap = subparsers.add_parser(
+        'compare', help=('Compare results against a baseline, running the '
+                         'benchmarks if no results are given'))
+    compare_ap.add_argument('baseline', nargs='?', default=DEFAULT_BASELINE,
+                            help='Baseline JSON file (default: %(default)s)')
+    compare_ap.add_argument('results', nargs='?', help='Results JSON file')
+    compare_ap.add_argument('-n', '--runs', type=int, default=DEFAULT_RUNS,
+                            help='Number of timed runs (default: %(default)s)')
+    compare_ap.add_argument(
+        '--time-threshold', type=float, default=DEFAULT_TIME_THRESHOLD,
+        help='Allowed relative time increase (default: %(default)s)')
+    compare_ap.add_argument(
+        '--memory-threshold', type=float, default=DEFAULT_MEMORY_THRESHOLD,
+        help='Allowed relative peak memory increase (default: %(default)s)')
+    args = ap.parse_args()
+    if args.command == 'run':
+        if args.benchmark == all_benchmarks_choice:
+            args.benchmark = sorted(BENCHMARKS)
+        results = run_benchmarks(args)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        return 0
+    if not os.path.isfile(args.baseline):
+        print('No baseline at {}; save one with run -o {}'
+              .format(args.baseline, args.baseline), file=sys.stderr)
+        return 1
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    if args.results:
+        with open(args.results, 'r') as f:
+            results = json.load(f)
+    else:
+        args.benchmark = sorted(baseline['benchmarks'])
+        results = run_benchmarks(args)
+    regressions = compare(baseline, results, args.time_threshold,
+                          args.memory_threshold)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())